@@ -1,21 +1,38 @@
+import json
+import orjson
+import asyncio
 import uvicorn
-import traceback
-from datetime import datetime
-from fastapi import FastAPI, Query, HTTPException, status
+import logging
+from uuid import uuid4
+from fastapi import FastAPI, Query, Header, HTTPException, status
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.encoders import jsonable_encoder
 from starlette.middleware.cors import CORSMiddleware
-from db import DBSession, ImageDB
-from download_images import download_images as download_images_on_disk
-from explore_images import (
-    next_image_in_album,
-    get_first_image_in_album as get_first_image_in_album_from_db,
-)
-from explore_images_v2 import next_image
+from sqlalchemy import select
+from db import ReadDBSession, ImageDB, ImageFileDB, get_image_rows, init_db, pragmas_report
+from jobs import job_queue
+from print_images import iter_images
+from explore_images_v2 import next_image, next_images
+from sessions import exploration_sessions
+from likes import like_counter
+from image_cache import image_cache
+from leaderboard import leaderboard
+from dashboard_stream import dashboard_broadcaster
+from static_files import file_response
+from thumbnails import thumbnails
+from refresh_images import album_owner_id
+from schemas import Image, Dashboard
+from metrics import metrics_middleware, metrics_response, profiler
 from settings import settings
 
+# dashboard ETags are valid only for the process that produced them
+PROCESS_TAG = uuid4().hex[:8]
+
 app = FastAPI(
     title='Не творог, а творог',
-    description='Решение Back End задач'
+    description='Решение Back End задач',
+    default_response_class=ORJSONResponse,
 )
 app.add_middleware(
     CORSMiddleware,
@@ -24,52 +41,257 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.middleware('http')(metrics_middleware)
+
+
+@app.on_event('startup')
+def startup():
+    init_db()
+    job_queue.resume()
+    logging.getLogger('uvicorn.error').info(f'SQLite engines: {pragmas_report()}')
+
+
+def get_image(id: int) -> dict | None:
+    'Returns image with pending likes applied'
+    return image_cache.get_image(id)
+
+
+def get_images(ids: list[int]) -> list[dict]:
+    'Returns images in order of `ids` with pending likes applied'
+    with ReadDBSession() as session:
+        images = get_image_rows(session, ids)
+    return [like_counter.merge(image) for image in images]
 
 
 @app.get(
     path='/api/download_images',
-    description='Загружает изображения из альбома',
+    description=(
+        'Ставит в очередь загрузку изображений из альбома и возвращает задачу '
+        '(если альбом уже загружается, возвращается текущая задача)'
+    ),
     tags=['10'],
 )
 def download_images(
     owner_id: int = Query(-197700721, description='ID владельца альбома'),
     album_id: int = Query(281940823, description='ID альбома'),
+    concurrency: int = Query(
+        settings.DOWNLOAD_CONCURRENCY,
+        ge=1,
+        description='Число одновременных загрузок изображений'
+    ),
+    full: bool = Query(
+        False,
+        description='Пройти весь альбом, игнорируя сохраненный прогресс'
+    ),
+    make_thumbnails: bool = Query(
+        False,
+        alias='thumbnails',
+        description='Создать уменьшенные копии изображений после загрузки'
+    ),
 ):
-    try:
-        download_images_on_disk(
+    return jsonable_encoder(
+        job_queue.enqueue(
+            kind='download',
             owner_id=owner_id,
             album_id=album_id,
-            print_info=False,
+            params={'concurrency': concurrency, 'full': full, 'thumbnails': make_thumbnails},
+        )
+    )
+
+
+@app.get(
+    path='/api/make_thumbnails',
+    description=(
+        'Ставит в очередь создание уменьшенных копий загруженных изображений альбома '
+        'и возвращает задачу'
+    ),
+    tags=['10'],
+)
+def make_thumbnails(
+    album_id: int = Query(281940823, description='ID альбома'),
+):
+    return jsonable_encoder(
+        job_queue.enqueue(
+            kind='thumbnails',
+            owner_id=None,
+            album_id=album_id,
+            params={},
         )
-    except Exception as ex:
+    )
+
+
+@app.get(
+    path='/api/refresh_images',
+    description=(
+        'Ставит в очередь обновление лайков VK и имен авторов загруженных изображений альбома '
+        '(файлы не скачиваются заново) и возвращает задачу'
+    ),
+    tags=['10'],
+)
+def refresh_images(
+    album_id: int = Query(281940823, description='ID альбома'),
+    owner_id: int | None = Query(
+        None,
+        description='ID владельца альбома (по умолчанию тот, с которым альбом загружался)'
+    ),
+):
+    if owner_id is None and (owner_id := album_owner_id(album_id)) is None:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f'Exception: {ex}\n\nTraceback: {traceback.format_exc()}'
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Такого альбома нет в базе. Возможно, вам нужно его загрузить.'
         )
-    return True
+
+    return jsonable_encoder(
+        job_queue.enqueue(
+            kind='refresh',
+            owner_id=owner_id,
+            album_id=album_id,
+            params={},
+        )
+    )
+
+
+@app.get(
+    path='/api/jobs/{id}',
+    description='Возвращает состояние задачи (прогресс: done/total изображений, bytes, errors)',
+    tags=['10'],
+)
+def get_job(id: int):
+    job = job_queue.get(id)
+
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Такой задачи нет.'
+        )
+
+    return jsonable_encoder(job)
+
+
+@app.get(
+    path='/api/jobs/{id}/cancel',
+    description='Отменяет задачу (выполняющаяся задача остановится после текущей страницы альбома)',
+    tags=['10'],
+)
+def cancel_job(id: int):
+    job = job_queue.cancel(id)
+
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Такой задачи нет.'
+        )
+
+    return jsonable_encoder(job)
 
 
 @app.get(
     path='/api/print_images',
-    description='Возвращает список загруженных изображений',
+    description=(
+        'Возвращает список загруженных изображений, упорядоченный по ID. '
+        'Для получения следующей страницы нужно передать в `after` значение заголовка X-Next-After. '
+        'В формате ndjson изображения передаются потоком, по одному JSON на строку'
+    ),
+    response_model=list[Image],
     tags=['10'],
 )
-def print_images():
-    with DBSession() as session:
-        return jsonable_encoder(
-            session.query(ImageDB).all()
+def print_images(
+    limit: int | None = Query(
+        None,
+        ge=1,
+        description=f'Размер страницы (по умолчанию {settings.IMAGES_PAGE_SIZE}, для ndjson - без ограничений)'
+    ),
+    after: int = Query(0, description='Вернуть изображения с ID больше данного'),
+    album_id: int | None = Query(None, description='ID альбома'),
+    author_id: int | None = Query(None, description='ID автора'),
+    format: str = Query('json', regex='^(json|ndjson)$', description='Формат ответа: json или ndjson'),
+):
+    images = iter_images(
+        after=after,
+        album_id=album_id,
+        author_id=author_id,
+        limit=limit if limit is not None or format == 'ndjson' else settings.IMAGES_PAGE_SIZE,
+    )
+
+    if format == 'ndjson':
+        return StreamingResponse(
+            (orjson.dumps(like_counter.merge(image)) + b'\n' for image in images),
+            media_type='application/x-ndjson',
+        )
+
+    page = [like_counter.merge(image) for image in images]
+    headers = {}
+    if page and len(page) == (limit or settings.IMAGES_PAGE_SIZE):
+        headers['X-Next-After'] = str(page[-1]['id'])
+
+    return ORJSONResponse(content=page, headers=headers)
+
+
+@app.get(
+    path='/api/images/{id}/file',
+    description=(
+        'Возвращает загруженный файл изображения. Поддерживаются условные запросы '
+        '(If-None-Match, If-Modified-Since) и запросы части файла (Range). '
+        'С параметром `width` возвращается уменьшенная копия наименьшей ширины не меньше '
+        f'заданной (доступные ширины: {", ".join(map(str, settings.THUMBNAIL_WIDTHS))}), '
+        'копия создается при первом запросе'
+    ),
+    response_class=Response,
+    responses={200: {'content': {'image/jpeg': {}, thumbnails.media_type: {}}}},
+    tags=['10'],
+)
+def get_image_file(
+    id: int,
+    width: int | None = Query(None, ge=1, description='Желаемая ширина изображения'),
+    if_none_match: str | None = Header(None),
+    if_modified_since: str | None = Header(None),
+    range: str | None = Header(None),
+    if_range: str | None = Header(None),
+):
+    with ReadDBSession() as session:
+        image = session.execute(
+            select(ImageDB.path, ImageFileDB.sha256)
+            .outerjoin(ImageFileDB, ImageFileDB.url == ImageDB.url)
+            .where(ImageDB.id == id)
+        ).first()
+
+    try:
+        if image is None:
+            raise FileNotFoundError(id)
+        if width is not None and (derivative_width := thumbnails.pick_width(width)) is not None:
+            return file_response(
+                thumbnails.get(id, image.path, derivative_width),
+                media_type=thumbnails.media_type,
+                if_none_match=if_none_match,
+                if_modified_since=if_modified_since,
+                range=range,
+                if_range=if_range,
+            )
+        return file_response(
+            image.path,
+            etag=None if image.sha256 is None else f'"{image.sha256}"',
+            if_none_match=if_none_match,
+            if_modified_since=if_modified_since,
+            range=range,
+            if_range=if_range,
+        )
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Такого изображения нет или его файл еще не загружен.'
         )
 
 
 @app.get(
     path='/api/get_first_image_in_album',
     description='Возвращает первое изображение из альбома',
+    response_model=Image,
     tags=['20'],
 )
 def get_first_image_in_album(
     album_id: int = Query(281940823, description='ID альбома'),
-) -> dict:
-    id = get_first_image_in_album_from_db(album_id)
+) -> ORJSONResponse:
+    id = image_cache.first_image_in_album(album_id)
 
     if id is None:
         raise HTTPException(
@@ -77,24 +299,19 @@ def get_first_image_in_album(
             detail='Такого альбома нет в базе. Возможно, вам нужно его загрузить.'
         )
 
-    with DBSession() as session:
-        return jsonable_encoder(
-            session
-            .query(ImageDB)
-            .where(ImageDB.id == id)
-            .first()
-        )
+    return ORJSONResponse(get_image(id))
 
 
 @app.get(
     path='/api/like_image',
     description='Лайкает изображение и возвращает следующее изображение в альбоме (циклически)',
+    response_model=Image,
     tags=['20'],
 )
 def like_image(
     id: int = Query(..., description='ID изображения')
-) -> dict:
-    next_id = next_image_in_album(id)
+) -> ORJSONResponse:
+    next_id = image_cache.next_image_in_album(id)
 
     if next_id is None:
         raise HTTPException(
@@ -102,35 +319,21 @@ def like_image(
             detail='Такого изображения нет в базе.'
         )
 
-    with DBSession() as session:
-        image: ImageDB = (
-            session
-            .query(ImageDB)
-            .where(ImageDB.id == id)
-            .first()
-        )
-        image.likes_count += 1
-        image.last_update = datetime.now()
-        session.flush()
-        session.commit()
-
-        return jsonable_encoder(
-            session
-            .query(ImageDB)
-            .where(ImageDB.id == next_id)
-            .first()
-        )
+    like_counter.like(id)
+
+    return ORJSONResponse(get_image(next_id))
 
 
 @app.get(
     path='/api/skip_image',
     description='Возвращает следующее изображение в альбоме (циклически)',
+    response_model=Image,
     tags=['20'],
 )
 def skip_image(
     id: int = Query(..., description='ID изображения')
-) -> dict:
-    next_id = next_image_in_album(id)
+) -> ORJSONResponse:
+    next_id = image_cache.next_image_in_album(id)
 
     if next_id is None:
         raise HTTPException(
@@ -138,72 +341,130 @@ def skip_image(
             detail='Такого изображения нет в базе.'
         )
 
-    with DBSession() as session:
-        return jsonable_encoder(
-            session
-            .query(ImageDB)
-            .where(ImageDB.id == next_id)
-            .first()
-        )
+    return ORJSONResponse(get_image(next_id))
+
+
+SESSION_DESCRIPTION = (
+    'Токен сессии исследования: изображения, показанные в сессии, не повторяются. '
+    'Пустое значение или истекший токен создают новую сессию, ее токен возвращается '
+    'в заголовке X-Exploration-Session'
+)
+
+
+def exploration_response(next_id: int | None, session: str | None) -> ORJSONResponse:
+    response = ORJSONResponse(get_image(next_id))
+    if session is not None:
+        response.headers['X-Exploration-Session'] = session
+    return response
 
 
 @app.get(
     path='/api/like_image_v2',
     description='Лайкает изображение и возвращает следующее случайное изображение',
+    response_model=Image,
     tags=['30'],
 )
 def like_image_v2(
     id: int = Query(..., description='ID изображения'),
     favourite_id: int = Query(..., description='ID изображения "фаворита"'),
-) -> dict:
-    next_id = next_image(favourite_id=favourite_id, id=id)
+    session: str | None = Query(None, description=SESSION_DESCRIPTION),
+) -> ORJSONResponse:
+    seen = None
+    if session is not None:
+        session, seen = exploration_sessions.get(session or None)
 
-    with DBSession() as session:
-        image: ImageDB = (
-            session
-            .query(ImageDB)
-            .where(ImageDB.id == id)
-            .first()
-        )
-        image.likes_count += 1
-        image.last_update = datetime.now()
-        session.flush()
-        session.commit()
-
-        return jsonable_encoder(
-            session
-            .query(ImageDB)
-            .where(ImageDB.id == next_id)
-            .first()
-        )
+    next_id = next_image(favourite_id=favourite_id, id=id, seen=seen)
+
+    like_counter.like(id)
+
+    return exploration_response(next_id, session)
 
 
 @app.get(
     path='/api/skip_image_v2',
     description='Возвращает следующее случайное изображение',
+    response_model=Image,
     tags=['30'],
 )
 def skip_image_v2(
     id: int = Query(-1, description='ID изображения (-1 получения случайного изображения)'),
     favourite_id: int = Query(..., description='ID изображения "фаворита"'),
-) -> dict:
+    session: str | None = Query(None, description=SESSION_DESCRIPTION),
+) -> ORJSONResponse:
+    seen = None
+    if session is not None:
+        session, seen = exploration_sessions.get(session or None)
+
     next_id = next_image(
         favourite_id=favourite_id,
         id=id,
+        seen=seen,
     )
 
-    with DBSession() as session:
-        return jsonable_encoder(
-            session
-            .query(ImageDB)
-            .where(ImageDB.id == next_id)
-            .first()
-        )
+    return exploration_response(next_id, session)
+
+
+def exploration_batch_response(next_ids: list[int], session: str | None) -> ORJSONResponse:
+    response = ORJSONResponse(get_images(next_ids))
+    if session is not None:
+        response.headers['X-Exploration-Session'] = session
+    return response
+
+
+@app.get(
+    path='/api/like_images_v2',
+    description=(
+        'Лайкает изображение и возвращает пачку следующих случайных изображений '
+        '(как count последовательных вызовов /api/skip_image_v2)'
+    ),
+    response_model=list[Image],
+    tags=['30'],
+)
+def like_images_v2(
+    id: int = Query(..., description='ID изображения'),
+    favourite_id: int = Query(..., description='ID изображения "фаворита"'),
+    count: int = Query(10, ge=1, le=settings.EXPLORE_BATCH_MAX, description='Число изображений'),
+    session: str | None = Query(None, description=SESSION_DESCRIPTION),
+) -> ORJSONResponse:
+    seen = None
+    if session is not None:
+        session, seen = exploration_sessions.get(session or None)
+
+    next_ids = next_images(favourite_id=favourite_id, id=id, count=count, seen=seen)
+
+    like_counter.like(id)
+
+    return exploration_batch_response(next_ids, session)
+
+
+@app.get(
+    path='/api/skip_images_v2',
+    description=(
+        'Возвращает пачку следующих случайных изображений '
+        '(как count последовательных вызовов /api/skip_image_v2)'
+    ),
+    response_model=list[Image],
+    tags=['30'],
+)
+def skip_images_v2(
+    id: int = Query(-1, description='ID изображения (-1 получения случайного изображения)'),
+    favourite_id: int = Query(..., description='ID изображения "фаворита"'),
+    count: int = Query(10, ge=1, le=settings.EXPLORE_BATCH_MAX, description='Число изображений'),
+    session: str | None = Query(None, description=SESSION_DESCRIPTION),
+) -> ORJSONResponse:
+    seen = None
+    if session is not None:
+        session, seen = exploration_sessions.get(session or None)
+
+    next_ids = next_images(favourite_id=favourite_id, id=id, count=count, seen=seen)
+
+    return exploration_batch_response(next_ids, session)
 
 
 @app.get(
     path='/api/print_dashboard',
     description='Возвращает дашборд изображений',
+    response_model=Dashboard,
     tags=['50'],
 )
 def top_images(
@@ -212,32 +473,100 @@ def top_images(
     secret: str = Query(
         'secret',
         description='Секрет для доступа к дашборду (по умолчанию "secret")'
-    )
+    ),
+    if_none_match: str | None = Header(None),
 ):
+    check_dashboard_secret(secret)
+
+    generation, top, last = leaderboard.dashboard(n, k)
+    etag = None if generation is None else f'"{PROCESS_TAG}-{generation}-{n}-{k}"'
+
+    if etag is not None and if_none_match == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+    return ORJSONResponse(
+        content={'top': top, 'last': last},
+        headers={} if etag is None else {'ETag': etag},
+    )
+
+
+def check_dashboard_secret(secret: str | None) -> None:
     if secret != settings.SECRET:  # Yes, yes, not safe
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail='Invalid secret',
         )
 
-    with DBSession() as session:
-        return {
-            'top': jsonable_encoder(
-                session
-                .query(ImageDB)
-                .order_by(ImageDB.likes_count.desc())
-                .limit(n)
-                .all()
-            ),
-            'last': jsonable_encoder(
-                session
-                .query(ImageDB)
-                .order_by(ImageDB.last_update.desc())
-                .where(ImageDB.last_update.isnot(None))
-                .limit(k)
-                .all()
-            )
-        }
+
+def server_sent_event(data: dict) -> str:
+    return f'event: dashboard\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+@app.get(
+    path='/api/dashboard_stream',
+    description=(
+        'Поток изменений дашборда (Server-Sent Events). Первое событие содержит весь '
+        'дашборд, следующие - только изменившиеся списки ("top" и/или "last")'
+    ),
+    tags=['50'],
+)
+async def dashboard_stream(
+    n: int = Query(5, description='Количество изображений в топе'),
+    k: int = Query(5, description='Количество изображений в последних'),
+    secret: str | None = Query(
+        None,
+        description='Секрет для доступа к дашборду (можно передать в заголовке X-Dashboard-Secret)'
+    ),
+    x_dashboard_secret: str | None = Header(None),
+):
+    check_dashboard_secret(x_dashboard_secret or secret)
+
+    loop = asyncio.get_running_loop()
+    queue, snapshot = await run_in_threadpool(dashboard_broadcaster.subscribe, n, k, loop)
+
+    async def events():
+        try:
+            yield server_sent_event(snapshot)
+            while True:
+                try:
+                    changes = await asyncio.wait_for(
+                        queue.get(),
+                        settings.DASHBOARD_STREAM_KEEPALIVE
+                    )
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                else:
+                    yield server_sent_event(changes)
+        finally:
+            dashboard_broadcaster.unsubscribe(n, k, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache'},
+    )
+
+
+@app.get('/metrics', include_in_schema=False)
+def metrics():
+    content, media_type = metrics_response()
+    return Response(content, media_type=media_type)
+
+
+@app.get(
+    path='/api/profiler',
+    description=(
+        'Включает профилирование медленных запросов: стеки запросов дольше `slow_ms` '
+        'сохраняются в PROFILE_PATH в формате folded stacks (0 - выключить)'
+    ),
+)
+def set_profiler(
+    slow_ms: int = Query(..., ge=0, description='Порог длительности запроса, мс'),
+    secret: str = Query(..., description='Секрет (тот же, что и для дашборда)'),
+):
+    check_dashboard_secret(secret)
+    profiler.slow_ms = slow_ms
+    return {'slow_ms': profiler.slow_ms}
 
 
 if __name__ == '__main__':
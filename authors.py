@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from vk_api import get_users_batches
+from settings import settings
+
+
+class AuthorResolver:
+    'Resolves VK user IDs to names with bulk `users.get` calls (combined by `execute`) and an LRU/TTL cache'
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache: OrderedDict[int, tuple[str, float]] = OrderedDict()
+        self.lock = Lock()
+
+    def _get_cached(self, user_id: int) -> str | None:
+        cached = self.cache.get(user_id)
+        if cached is None:
+            return None
+
+        name, expires = cached
+        if expires < monotonic():
+            del self.cache[user_id]
+            return None
+
+        self.cache.move_to_end(user_id)
+        return name
+
+    def _put(self, user_id: int, name: str) -> None:
+        self.cache[user_id] = (name, monotonic() + self.ttl)
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def resolve(self, users_ids: list[int] | set[int], fresh: bool = False) -> dict[int, str]:
+        'Returns names for all given IDs, requesting only missing ones (all if `fresh`) from VK'
+        names = {}
+        with self.lock:
+            for user_id in set() if fresh else set(users_ids):
+                name = self._get_cached(user_id)
+                if name is not None:
+                    names[user_id] = name
+
+        missing = sorted(set(users_ids) - names.keys())
+        batches = [
+            missing[i:i + settings.USERS_BATCH_SIZE]
+            for i in range(0, len(missing), settings.USERS_BATCH_SIZE)
+        ]
+        for users in get_users_batches(batches):
+            with self.lock:
+                for user_info in users:
+                    name = f'{user_info["first_name"]} {user_info["last_name"]}'
+                    names[user_info['id']] = name
+                    self._put(user_info['id'], name)
+
+        return names
+
+
+author_resolver = AuthorResolver(
+    max_size=settings.AUTHORS_CACHE_SIZE,
+    ttl=settings.AUTHORS_CACHE_TTL,
+)
@@ -0,0 +1,89 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_PATH = ROOT / 'benchmarks' / 'results'
+DATA_PATH = ROOT / 'benchmarks' / 'data'
+
+
+def percentile(values: list[float], q: float) -> float:
+    'Nearest-rank percentile of unsorted values'
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values) + 0.5) - 1))]
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    'Latencies (seconds) of successful requests to a summary in milliseconds'
+    return {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'throughput': (len(latencies) + errors) / elapsed if elapsed else 0.0,
+        'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else float('nan'),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies) * 1000 if latencies else float('nan'),
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(name: str, params: dict, results: list[dict], out: Path | None = None) -> Path:
+    'Saves results with environment info to benchmarks/results/<name>-<time>-<revision>.json'
+    revision = git_revision()
+    created = datetime.now()
+    path = out or RESULTS_PATH / f'{name}-{created:%Y%m%d-%H%M%S}-{revision or "unknown"}.json'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(
+        {
+            'benchmark': name,
+            'revision': revision,
+            'created': created.isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'params': params,
+            'results': results,
+        },
+        indent=2,
+        ensure_ascii=False,
+    ))
+    return path
+
+
+def compare(previous_path: Path, results: list[dict], keys: tuple[str, ...], metrics: tuple[str, ...]) -> list[str]:
+    'Lines comparing `metrics` of results matched by `keys` with a previous results file'
+    previous = {
+        tuple(result[key] for key in keys): result
+        for result in json.loads(Path(previous_path).read_text())['results']
+    }
+    lines = []
+    for result in results:
+        old = previous.get(tuple(result[key] for key in keys))
+        if old is None or old.get('failed') or result.get('failed'):
+            continue
+        changes = ', '.join(
+            f'{metric} {old[metric]:.2f} -> {result[metric]:.2f} ({(result[metric] / old[metric] - 1) * 100:+.0f}%)'
+            for metric in metrics
+            if old.get(metric)
+        )
+        lines.append(f'{" ".join(str(result[key]) for key in keys)}: {changes}')
+    return lines
@@ -0,0 +1,134 @@
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+import click
+from benchmarks.common import ROOT
+from benchmarks.synthetic_db import make_db
+
+# keys of image responses of the first revision as observed in production. That
+# revision returned ORM objects, their attributes are loaded in order of a set of
+# mapper properties, which depends on object addresses and may differ between runs
+BASELINE_ORDER = (
+    'author_id', 'album_position', 'likes_count', 'path', 'id',
+    'image_id', 'album_id', 'author_name', 'url', 'last_update',
+)
+
+# runs in the checked tree, so it may use only what every revision has
+CLIENT_SCRIPT = '''
+import json, sys
+from starlette.testclient import TestClient
+from api import app
+with TestClient(app) as client:
+    print(json.dumps([client.get(path).content.decode() for path in sys.argv[1:]]))
+'''
+
+
+def git(*args: str) -> str:
+    return subprocess.run(
+        ['git', *args], cwd=ROOT, capture_output=True, text=True, check=True,
+    ).stdout.strip()
+
+
+def fetch(tree: Path, source: Path, db_path: Path, paths: list[str], hash_seed: int) -> list[bytes]:
+    '''Returns response bodies of the app of `tree` run from its directory
+
+    The app may write to the database (e.g. migrations at startup), so every run
+    gets a fresh copy of `source` at `db_path`. Old revisions always open `db.db`
+    of the working directory, newer ones take `DB_URL`
+    '''
+    shutil.copyfile(source, db_path)
+    output = subprocess.run(
+        [sys.executable, '-c', CLIENT_SCRIPT, *paths],
+        cwd=tree,
+        env={
+            **os.environ,
+            'DB_URL': f'sqlite:///{db_path}',
+            'PYTHONHASHSEED': str(hash_seed),
+        },
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return [body.encode() for body in json.loads(output.splitlines()[-1])]
+
+
+def raw_items(body: bytes) -> dict[str, str]:
+    'Returns `"key":value` fragments of a flat JSON object: key -> raw value text'
+    text = body.decode()
+    decoder = json.JSONDecoder()
+    items, i = {}, 1
+    while text[i] != '}':
+        key, i = decoder.raw_decode(text, i)
+        _, end = decoder.raw_decode(text, i + 1)  # after ':'
+        items[key] = text[i + 1:end]
+        i = end + (text[end] == ',')
+    return items
+
+
+def expected_body(reference: bytes, body: bytes) -> bytes:
+    '''Reference response with keys in `BASELINE_ORDER`, followed by keys added
+    later (taken from `body`)
+    '''
+    old, new = raw_items(reference), raw_items(body)
+    keys = [key for key in BASELINE_ORDER if key in old]
+    keys += [key for key in old if key not in keys] + [key for key in new if key not in old]
+    items = {**new, **old}
+    return ('{' + ','.join(f'{json.dumps(key)}:{items[key]}' for key in keys) + '}').encode()
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--revision", default=None, help="Ревизия для сравнения (по умолчанию первый коммит)")
+@click.option("--rows", default=1000, show_default=True, help="Размер синтетической таблицы images")
+@click.option("--requests", "requests_count", default=50, show_default=True, help="Запросов к /api/skip_image")
+@click.option("--attempts", default=5, show_default=True, help="Запусков старой ревизии")
+def run(revision: str | None, rows: int, requests_count: int, attempts: int):
+    """Checks that /api/skip_image responses are byte-compatible with an older revision"""
+    revision = revision or git('rev-list', '--max-parents=0', 'HEAD').splitlines()[0]
+    rng = random.Random(0)
+    paths = [f'/api/skip_image?id={rng.randint(1, rows)}' for _ in range(requests_count)]
+    source = make_db(rows)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / 'db.db'
+        bodies = fetch(ROOT, source, db_path, paths, hash_seed=0)
+        if fetch(ROOT, source, db_path, paths, hash_seed=1) != bodies:
+            raise click.ClickException('Ответы текущей версии зависят от запуска')
+
+        tree = Path(tmp) / 'reference'
+        git('worktree', 'add', '--detach', str(tree), revision)
+        try:
+            exact = 0
+            for hash_seed in range(attempts):
+                references = fetch(tree, source, tree / 'db.db', paths, hash_seed)
+                for path, body, reference in zip(paths, bodies, references):
+                    if body != expected_body(reference, body):
+                        click.echo(f'{path}:\n  {revision[:7]}: {reference.decode()}\n  текущая: {body.decode()}')
+                        raise click.ClickException(f'Ответы отличаются от ответов {revision[:7]}')
+                # keys order of the reference may be the observed one in some runs
+                exact += all(
+                    body.startswith(reference[:-1])
+                    for body, reference in zip(bodies, references)
+                )
+        finally:
+            git('worktree', 'remove', '--force', str(tree))
+
+    click.echo(
+        f'Ответы совместимы с {revision[:7]}: значения совпадают побайтово, ключи в порядке '
+        f'{", ".join(BASELINE_ORDER)} (полное совпадение в {exact} из {attempts} запусков '
+        f'{revision[:7]}), добавленные ключи: '
+        f'{", ".join(key for key in raw_items(bodies[0]) if key not in BASELINE_ORDER) or "нет"}'
+    )
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,247 @@
+'''Local stand-in for VK API and image hosting for offline ingestion runs
+
+    FAKE_VK_LATENCY=0.05 uvicorn benchmarks.fake_vk:app --port 4100
+    VK_API_URL=http://127.0.0.1:4100/method python download_images.py --album-id 1000
+
+Any album exists and has `album_id` photos (album 1000 has 1000 photos), so no
+state is needed. Photos are JPEGs with unique contents, every
+`FAKE_VK_DISTINCT_IMAGES`-th photo looks the same (perceptual copies).
+Photos get `FAKE_VK_LIKES_GROWTH` likes per second to exercise refresh_images.py
+'''
+import asyncio
+import io
+import json
+import random
+import re
+import time
+from collections import Counter, deque
+from threading import Lock
+from fastapi import FastAPI, Form, Query, Request
+from fastapi.responses import Response
+from PIL import Image
+from pydantic import BaseSettings
+
+
+class FakeVKSettings(BaseSettings):
+    LATENCY: float = 0.0  # seconds added to every API call
+    IMAGE_LATENCY: float = 0.0  # seconds added to every image request
+    JITTER: float = 0.5  # latency is multiplied by random 1 ± JITTER
+    ERROR_RATE: float = 0.0  # share of API calls failing with "internal server error"
+    IMAGE_ERROR_RATE: float = 0.0  # share of image requests failing with 503
+    RATE_LIMIT: float = 0.0  # API calls per second, 0 means no limit (VK allows 3)
+    IMAGE_WIDTH: int = 1080
+    IMAGE_HEIGHT: int = 720
+    DISTINCT_IMAGES: int = 64
+    LIKES_GROWTH: float = 0.0  # likes per second every photo gets since the server start
+
+    class Config:
+        env_prefix = 'FAKE_VK_'
+
+
+fake_settings = FakeVKSettings()
+app = FastAPI(title='Fake VK API')
+
+stats: Counter = Counter()
+stats_lock = Lock()
+calls: deque[float] = deque()  # API call times within the last second
+images: list[bytes] = []
+started = time.monotonic()
+
+
+def count(**values: int) -> None:
+    with stats_lock:
+        stats.update(values)
+
+
+def make_image(seed: int) -> bytes:
+    rng = random.Random(seed)
+    image = Image.effect_noise((fake_settings.IMAGE_WIDTH, fake_settings.IMAGE_HEIGHT), 32).convert('RGB')
+    image = Image.blend(
+        image,
+        Image.linear_gradient('L').rotate(rng.randrange(360)).resize(image.size).convert('RGB'),
+        0.7,
+    )
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+@app.on_event('startup')
+def startup():
+    images.extend(make_image(seed) for seed in range(fake_settings.DISTINCT_IMAGES))
+
+
+async def delay(latency: float) -> None:
+    if latency > 0:
+        await asyncio.sleep(latency * random.uniform(1 - fake_settings.JITTER, 1 + fake_settings.JITTER))
+
+
+def api_error() -> dict | None:
+    'Returns VK error response for rate limited or randomly failed calls'
+    if fake_settings.RATE_LIMIT > 0:
+        now = time.monotonic()
+        with stats_lock:
+            while calls and calls[0] < now - 1:
+                calls.popleft()
+            limited = len(calls) >= fake_settings.RATE_LIMIT
+            if not limited:
+                calls.append(now)
+        if limited:
+            count(rate_limited=1)
+            return {'error': {'error_code': 6, 'error_msg': 'Too many requests per second'}}
+
+    if random.random() < fake_settings.ERROR_RATE:
+        count(errors=1)
+        return {'error': {'error_code': 10, 'error_msg': 'Internal server error'}}
+
+    return None
+
+
+def photo(base_url: str, owner_id: int, album_id: int, i: int) -> dict:
+    return {
+        'id': 100000 + i,
+        'album_id': album_id,
+        'owner_id': owner_id,
+        'user_id': 1 + i % 997,
+        'likes': {
+            'user_likes': 0,
+            'count': i % 13 + int((time.monotonic() - started) * fake_settings.LIKES_GROWTH),
+        },
+        'sizes': [
+            {
+                'type': type,
+                'width': fake_settings.IMAGE_WIDTH // scale,
+                'height': fake_settings.IMAGE_HEIGHT // scale,
+                'url': f'{base_url}/images/{album_id}/{100000 + i}.jpg?type={type}',
+            }
+            for type, scale in (('s', 8), ('m', 4), ('x', 2), ('w', 1))
+        ],
+    }
+
+
+def photos_get(base_url: str, owner_id: int, album_id: int, offset: int = 0, count: int = 50, **_) -> dict:
+    ids = range(offset, min(offset + min(count, 1000), album_id))
+    return {
+        'count': album_id,
+        'items': [photo(base_url, owner_id, album_id, i) for i in ids],
+    }
+
+
+def photos_get_by_id(base_url: str, photos: str, **_) -> list:
+    'Album of photos is unknown here, so they are reported as photos of album 0'
+    result = []
+    for owner_photo in str(photos).split(','):
+        owner_id, id = map(int, owner_photo.rsplit('_', 1))
+        if id >= 100000:
+            result.append(photo(base_url, owner_id, 0, id - 100000))
+    return result
+
+
+def users_get(user_ids: str, **_) -> list:
+    return [
+        {'id': int(id), 'first_name': f'User{id}', 'last_name': 'Fake'}
+        for id in str(user_ids).split(',')
+        if id
+    ]
+
+
+METHODS = {'photos.get': photos_get, 'photos.getById': photos_get_by_id, 'users.get': users_get}
+
+
+@app.get('/method/photos.get')
+async def photos_get_method(
+    request: Request,
+    owner_id: int,
+    album_id: int,
+    offset: int = 0,
+    count_: int = Query(50, alias='count'),
+):
+    count(**{'photos.get': 1})
+    await delay(fake_settings.LATENCY)
+    if (error := api_error()) is not None:
+        return error
+
+    return {'response': photos_get(str(request.base_url).rstrip('/'), owner_id, album_id, offset, count_)}
+
+
+@app.get('/method/photos.getById')
+async def photos_get_by_id_method(request: Request, photos: str):
+    count(**{'photos.getById': 1})
+    await delay(fake_settings.LATENCY)
+    if (error := api_error()) is not None:
+        return error
+
+    return {'response': photos_get_by_id(str(request.base_url).rstrip('/'), photos)}
+
+
+@app.get('/method/users.get')
+async def users_get_method(user_ids: str):
+    count(**{'users.get': 1})
+    await delay(fake_settings.LATENCY)
+    if (error := api_error()) is not None:
+        return error
+
+    return {'response': users_get(user_ids)}
+
+
+@app.post('/method/execute')
+async def execute(request: Request, code: str = Form(...)):
+    '''Supports only code made by `vk_api.VKClient.execute`:
+    `return [API.method({json params}),...];`
+
+    Nested calls fail with false at `FAKE_VK_ERROR_RATE` as well
+    '''
+    count(execute=1)
+    await delay(fake_settings.LATENCY)
+    if (error := api_error()) is not None:
+        return error
+
+    base_url = str(request.base_url).rstrip('/')
+    decoder = json.JSONDecoder()
+    response = []
+    execute_errors = []
+    for match in re.finditer(r'API\.([\w.]+)\(', code):
+        method = match.group(1)
+        params, _ = decoder.raw_decode(code, match.end())
+        count(**{f'execute:{method}': 1})
+        if method not in METHODS:
+            return {'error': {'error_code': 3, 'error_msg': f'Unknown method passed: {method}'}}
+        if random.random() < fake_settings.ERROR_RATE:
+            count(errors=1)
+            response.append(False)
+            execute_errors.append({'method': method, 'error_code': 10, 'error_msg': 'Internal server error'})
+            continue
+        if method.startswith('photos.'):
+            params = {'base_url': base_url, **params}
+        response.append(METHODS[method](**params))
+
+    return {'response': response, **({'execute_errors': execute_errors} if execute_errors else {})}
+
+
+@app.get('/images/{album_id}/{id}.jpg')
+async def image(album_id: int, id: int):
+    count(images=1)
+    await delay(fake_settings.IMAGE_LATENCY)
+    if random.random() < fake_settings.IMAGE_ERROR_RATE:
+        count(image_errors=1)
+        return Response(status_code=503)
+
+    # data after the JPEG end marker is ignored by decoders but makes files unique
+    content = images[id % len(images)] + f'{album_id}/{id}'.encode()
+    count(bytes=len(content))
+    return Response(content, media_type='image/jpeg')
+
+
+@app.get('/stats')
+def get_stats():
+    'Counters of requests by method, errors, rate limited calls and served bytes'
+    with stats_lock:
+        return dict(stats)
+
+
+@app.get('/stats/reset')
+def reset_stats():
+    with stats_lock:
+        stats.clear()
+        calls.clear()
+    return {}
@@ -0,0 +1,169 @@
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from time import perf_counter
+import click
+import requests
+from benchmarks.common import ROOT, save_results, compare
+from benchmarks.requests_bench import free_port
+
+
+def start_fake_vk(port: int, **config) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [
+            sys.executable, '-m', 'uvicorn', 'benchmarks.fake_vk:app',
+            '--port', str(port),
+            '--log-level', 'warning',
+        ],
+        cwd=ROOT,
+        env={
+            **os.environ,
+            'PYTHONPATH': str(ROOT),
+            **{f'FAKE_VK_{name.upper()}': str(value) for name, value in config.items()},
+        },
+    )
+    for _ in range(600):
+        if server.poll() is not None:
+            raise click.ClickException('Фейковый VK завершился при запуске')
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/stats').ok:
+                return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.terminate()
+    raise click.ClickException('Фейковый VK не запустился')
+
+
+def ingest(album_size: int, vk_url: str, concurrency: int, requests_per_second: float) -> dict | None:
+    '''Downloads the album into a temporary database and images directory in a child process
+
+    Returns None if the download failed (e.g. on VK errors)
+    '''
+    with tempfile.TemporaryDirectory() as workdir:
+        start = perf_counter()
+        output = subprocess.run(
+            [
+                sys.executable, '-m', 'benchmarks.ingestion_bench', 'ingest',
+                '--album-size', str(album_size),
+                '--concurrency', str(concurrency),
+            ],
+            cwd=ROOT,
+            env={
+                **os.environ,
+                'PYTHONPATH': str(ROOT),
+                'DB_URL': f'sqlite:///{workdir}/db.db',
+                'IMAGES_PATH': f'{workdir}/images',
+                'VK_API_URL': f'{vk_url}/method',
+                'VK_REQUESTS_PER_SECOND': str(requests_per_second),
+            },
+            capture_output=True,
+            text=True,
+        )
+        elapsed = perf_counter() - start
+        if output.returncode != 0:
+            click.echo(output.stderr.strip().splitlines()[-1], err=True)
+            return None
+
+    return {**json.loads(output.stdout.splitlines()[-1]), 'elapsed': elapsed}
+
+
+@click.group()
+def cli():
+    """Offline ingestion benchmarks"""
+
+
+@cli.command()
+@click.option("--album-size", "album_sizes", multiple=True, type=int, default=(100, 1000, 5000), show_default=True, help="Размеры альбомов")
+@click.option("--concurrency", default=4, show_default=True, help="Одновременных загрузок изображений")
+@click.option("--requests-per-second", default=1000.0, show_default=True, help="Ограничение запросов к API на клиенте (VK_REQUESTS_PER_SECOND)")
+@click.option("--latency", default=0.05, show_default=True, help="Задержка ответов API, секунд")
+@click.option("--image-latency", default=0.02, show_default=True, help="Задержка ответов хостинга изображений, секунд")
+@click.option("--error-rate", default=0.0, show_default=True, help="Доля ошибок API")
+@click.option("--image-error-rate", default=0.0, show_default=True, help="Доля ошибок хостинга изображений")
+@click.option("--rate-limit", default=0.0, show_default=True, help="Ограничение запросов к API в секунду на сервере (ошибка 6), 0 - без ограничения")
+@click.option("--out", type=click.Path(path_type=Path), default=None, help="Файл результатов (по умолчанию benchmarks/results/...)")
+@click.option("--compare", "previous", type=click.Path(exists=True, path_type=Path), default=None, help="Сравнить с предыдущими результатами")
+def run(
+    album_sizes: tuple[int],
+    concurrency: int,
+    requests_per_second: float,
+    out: Path | None,
+    previous: Path | None,
+    **fake_vk_config,
+):
+    """Measures `download_images` throughput against a local fake VK"""
+    port = free_port()
+    server = start_fake_vk(port, **fake_vk_config)
+    vk_url = f'http://127.0.0.1:{port}'
+    results = []
+
+    try:
+        for album_size in album_sizes:
+            requests.get(f'{vk_url}/stats/reset')
+            result = ingest(album_size, vk_url, concurrency, requests_per_second)
+            vk_stats = requests.get(f'{vk_url}/stats').json()
+            if result is None:
+                results.append({'album_size': album_size, 'failed': True, 'vk_stats': vk_stats})
+                click.echo(f'{album_size:6} изображений: загрузка не удалась')
+                continue
+
+            # requests to the API, calls made inside `execute` are not counted
+            api_calls = sum(vk_stats.get(method, 0) for method in ('photos.get', 'users.get', 'execute'))
+            result = {
+                'album_size': album_size,
+                'images_per_second': result['done'] / result['elapsed'],
+                'vk_calls_per_image': api_calls / max(result['done'], 1),
+                'bytes_per_second': result['bytes'] / result['elapsed'],
+                'peak_rss_mb': result['peak_rss_kb'] / 1024,
+                'vk_stats': vk_stats,
+                **result,
+            }
+            results.append(result)
+            click.echo(
+                f'{album_size:6} изображений: {result["images_per_second"]:8.1f} изобр./с, '
+                f'{result["vk_calls_per_image"]:.3f} вызовов API на изображение, '
+                f'{result["bytes_per_second"] / 2 ** 20:7.2f} МиБ/с, '
+                f'пик RSS {result["peak_rss_mb"]:.0f} МиБ, ошибок загрузки: {result["errors"]}'
+            )
+    finally:
+        server.terminate()
+        server.wait()
+
+    path = save_results(
+        'ingestion',
+        {'concurrency': concurrency, 'requests_per_second': requests_per_second, **fake_vk_config},
+        results,
+        out,
+    )
+    click.echo(f'Результаты сохранены в {path}')
+
+    if previous is not None:
+        click.echo(f'Сравнение с {previous}:')
+        for line in compare(previous, results, ('album_size',), ('images_per_second', 'vk_calls_per_image', 'peak_rss_mb')):
+            click.echo(f'  {line}')
+
+
+@cli.command(name='ingest', hidden=True)
+@click.option("--album-size", type=int, required=True)
+@click.option("--concurrency", type=int, required=True)
+def ingest_child(album_size: int, concurrency: int):
+    """Child process of `run`: settings are taken from the environment"""
+    from download_images import download_images
+
+    stats = download_images(
+        owner_id=-1,
+        album_id=album_size,  # fake VK albums have `album_id` photos
+        print_info=False,
+        concurrency=concurrency,
+    )
+    stats['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    click.echo(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    cli()
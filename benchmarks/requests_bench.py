@@ -0,0 +1,255 @@
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from pathlib import Path
+from time import perf_counter
+from typing import Callable
+import click
+import requests
+from benchmarks.common import ROOT, DATA_PATH, summarize, save_results, compare
+from benchmarks.synthetic_db import make_db
+
+SECRET = 'benchmark'
+
+# endpoint name -> path with random IDs
+ENDPOINTS: dict[str, Callable[[random.Random, int], str]] = {
+    'like_image': lambda rng, rows: f'/api/like_image?id={rng.randint(1, rows)}',
+    'skip_image': lambda rng, rows: f'/api/skip_image?id={rng.randint(1, rows)}',
+    'skip_image_v2': lambda rng, rows: (
+        f'/api/skip_image_v2?id={rng.randint(1, rows)}&favourite_id={rng.randint(1, rows)}'
+    ),
+    'print_dashboard': lambda rng, rows: f'/api/print_dashboard?n=5&k=5&secret={SECRET}',
+}
+
+
+def drive(
+    get: Callable[[str], int],
+    endpoint: str,
+    rows: int,
+    requests_count: int,
+    concurrency: int,
+    seed: int = 0,
+) -> dict:
+    'Sends `requests_count` requests to the endpoint from `concurrency` threads'
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+    sent = count()
+
+    def worker(worker_id: int) -> None:
+        nonlocal errors
+        rng = random.Random(seed * 1000 + worker_id)
+        while next(sent) < requests_count:
+            path = ENDPOINTS[endpoint](rng, rows)
+            start = perf_counter()
+            try:
+                ok = get(path) == 200
+            except Exception:
+                ok = False
+            elapsed = perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors += 1
+
+    start = perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    return summarize(latencies, errors, perf_counter() - start)
+
+
+def bench_endpoints(
+    get: Callable[[str], int],
+    endpoints: list[str],
+    rows: int,
+    requests_count: int,
+    warmup: int,
+    concurrency: int,
+) -> list[dict]:
+    results = []
+    for endpoint in endpoints:
+        drive(get, endpoint, rows, warmup, concurrency, seed=1)  # caches, pools, lazy loads
+        results.append({'endpoint': endpoint, **drive(get, endpoint, rows, requests_count, concurrency)})
+    return results
+
+
+def app_env(db_path: Path) -> dict:
+    return {
+        **os.environ,
+        'DB_URL': f'sqlite:///{db_path}',
+        'SECRET': SECRET,
+        'PYTHONPATH': str(ROOT),
+    }
+
+
+def fresh_copy(db_path: Path) -> Path:
+    'Benchmarks write likes, so every run gets a copy of the synthetic database'
+    run_path = DATA_PATH / 'run.db'
+    for suffix in ('', '-wal', '-shm'):
+        Path(f'{run_path}{suffix}').unlink(missing_ok=True)
+    shutil.copyfile(db_path, run_path)
+    return run_path
+
+
+def run_in_process(db_path: Path, rows: int, endpoints: list[str], **options) -> list[dict]:
+    'Runs the app with TestClient in a child process configured for the database'
+    output = subprocess.run(
+        [
+            sys.executable, '-m', 'benchmarks.requests_bench', 'in-process',
+            '--rows', str(rows),
+            *[arg for endpoint in endpoints for arg in ('--endpoint', endpoint)],
+            *[arg for name, value in options.items() for arg in (f'--{name.replace("_", "-")}', str(value))],
+        ],
+        cwd=ROOT,
+        env=app_env(db_path),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_uvicorn(db_path: Path, rows: int, endpoints: list[str], workers: int, **options) -> list[dict]:
+    'Runs the app with uvicorn and sends requests over keep-alive HTTP connections'
+    port = free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable, '-m', 'uvicorn', 'api:app',
+            '--port', str(port),
+            '--workers', str(workers),
+            '--log-level', 'warning',
+        ],
+        cwd=ROOT,
+        env=app_env(db_path),
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    local = threading.local()
+
+    def get(path: str) -> int:
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return local.session.get(base_url + path).status_code
+
+    try:
+        for _ in range(300):
+            if server.poll() is not None:
+                raise click.ClickException('uvicorn завершился при запуске')
+            try:
+                if requests.get(f'{base_url}/openapi.json').ok:
+                    break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        else:
+            raise click.ClickException('uvicorn не запустился')
+
+        return bench_endpoints(get, endpoints, rows, **options)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+@click.group()
+def cli():
+    """Request-path load benchmarks"""
+
+
+@cli.command()
+@click.option("--rows", multiple=True, type=int, default=(10_000, 100_000, 1_000_000), show_default=True, help="Размеры синтетической таблицы images")
+@click.option("--album-size", default=500, show_default=True, help="Изображений в альбоме")
+@click.option("--mode", multiple=True, type=click.Choice(['in-process', 'uvicorn']), default=('in-process', 'uvicorn'), show_default=True, help="Как запускать приложение")
+@click.option("--endpoint", "endpoints", multiple=True, type=click.Choice(list(ENDPOINTS)), default=tuple(ENDPOINTS), help="Эндпоинты (по умолчанию все)")
+@click.option("--requests", "requests_count", default=2000, show_default=True, help="Запросов к каждому эндпоинту")
+@click.option("--warmup", default=100, show_default=True, help="Запросов для прогрева перед замером")
+@click.option("--concurrency", default=8, show_default=True, help="Одновременных запросов")
+@click.option("--workers", default=1, show_default=True, help="Процессов uvicorn")
+@click.option("--out", type=click.Path(path_type=Path), default=None, help="Файл результатов (по умолчанию benchmarks/results/...)")
+@click.option("--compare", "previous", type=click.Path(exists=True, path_type=Path), default=None, help="Сравнить с предыдущими результатами")
+def run(
+    rows: tuple[int],
+    album_size: int,
+    mode: tuple[str],
+    endpoints: tuple[str],
+    requests_count: int,
+    warmup: int,
+    concurrency: int,
+    workers: int,
+    out: Path | None,
+    previous: Path | None,
+):
+    """Measures latency percentiles and throughput of endpoints on synthetic databases"""
+    results = []
+    options = {'requests_count': requests_count, 'warmup': warmup, 'concurrency': concurrency}
+
+    for size in rows:
+        click.echo(f'Подготовка базы на {size} изображений...')
+        db_path = make_db(size, album_size)
+
+        for run_mode in mode:
+            click.echo(f'{size} изображений, {run_mode}:')
+            if run_mode == 'in-process':
+                mode_results = run_in_process(fresh_copy(db_path), size, list(endpoints), **options)
+            else:
+                mode_results = run_uvicorn(fresh_copy(db_path), size, list(endpoints), workers, **options)
+
+            for result in mode_results:
+                result = {'rows': size, 'mode': run_mode, **result}
+                results.append(result)
+                click.echo(
+                    f'  {result["endpoint"]:16} p50 {result["p50_ms"]:8.2f} ms  p95 {result["p95_ms"]:8.2f} ms  '
+                    f'p99 {result["p99_ms"]:8.2f} ms  {result["throughput"]:8.1f} rps  ошибок: {result["errors"]}'
+                )
+
+    path = save_results(
+        'requests',
+        {'album_size': album_size, 'workers': workers, **options},
+        results,
+        out,
+    )
+    click.echo(f'Результаты сохранены в {path}')
+
+    if previous is not None:
+        click.echo(f'Сравнение с {previous}:')
+        for line in compare(previous, results, ('rows', 'mode', 'endpoint'), ('p50_ms', 'p99_ms', 'throughput')):
+            click.echo(f'  {line}')
+
+
+@cli.command(name='in-process', hidden=True)
+@click.option("--rows", type=int, required=True)
+@click.option("--endpoint", "endpoints", multiple=True, required=True)
+@click.option("--requests-count", type=int, required=True)
+@click.option("--warmup", type=int, required=True)
+@click.option("--concurrency", type=int, required=True)
+def in_process(rows: int, endpoints: tuple[str], requests_count: int, warmup: int, concurrency: int):
+    """Child process of `run`: settings are taken from the environment"""
+    from starlette.testclient import TestClient
+    from api import app
+
+    with TestClient(app) as client:
+        results = bench_endpoints(
+            lambda path: client.get(path).status_code,
+            list(endpoints),
+            rows,
+            requests_count=requests_count,
+            warmup=warmup,
+            concurrency=concurrency,
+        )
+    click.echo(json.dumps(results))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,62 @@
+import random
+import sqlite3
+from datetime import datetime, timedelta
+from pathlib import Path
+from sqlalchemy import create_engine
+from benchmarks.common import DATA_PATH
+
+
+def make_db(rows: int, album_size: int = 500, seed: int = 0, path: Path | None = None) -> Path:
+    '''Creates SQLite database with `rows` synthetic images in albums of `album_size`
+
+    Schema is created from the application models. Likes follow a heavy-tailed
+    distribution and about a tenth of images have `last_update`, like in production.
+    Existing database with the same parameters is reused
+    '''
+    from db import Base  # models only, application engines are not connected
+
+    path = path or DATA_PATH / f'images-{rows}-{album_size}-{seed}.db'
+    if path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.unlink(missing_ok=True)
+
+    Base.metadata.create_all(create_engine(f'sqlite:///{tmp_path}'))
+
+    rng = random.Random(seed)
+    start = datetime(2022, 4, 1)
+    connection = sqlite3.connect(tmp_path)
+    connection.execute('PRAGMA journal_mode = OFF')
+    connection.execute('PRAGMA synchronous = OFF')
+
+    def images():
+        for i in range(rows):
+            album_id, album_position = 1000 + i // album_size, i % album_size
+            author_id = rng.randrange(1, max(rows // 20, 2))
+            liked = rng.random() < 0.1
+            yield (
+                i + 1,
+                album_id,
+                album_position,
+                400000000 + i,
+                author_id,
+                f'Author {author_id}',
+                int(rng.paretovariate(1.5)) - 1,
+                f'https://example.com/{album_id}/{i}.jpg',
+                f'images/{album_id}/{400000000 + i}.jpg',
+                (start + timedelta(seconds=rng.randrange(30 * 24 * 3600))).isoformat(sep=' ', timespec='microseconds')
+                if liked else None,
+            )
+
+    with connection:
+        connection.executemany(
+            'INSERT INTO images (id, album_id, album_position, image_id, author_id, '
+            'author_name, likes_count, url, path, last_update) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            images(),
+        )
+    connection.execute('ANALYZE')
+    connection.close()
+
+    tmp_path.rename(path)
+    return path
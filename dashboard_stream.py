@@ -0,0 +1,108 @@
+import asyncio
+import traceback
+from threading import Event, Lock, Thread
+from time import sleep
+from fastapi.encoders import jsonable_encoder
+from leaderboard import leaderboard
+from likes import like_counter
+from settings import settings
+
+
+class DashboardBroadcaster:
+    '''Pushes dashboard changes to stream subscribers
+
+    Dashboard is computed once per distinct (n, k) for all subscribers and only
+    the changed lists ("top" and/or "last") are published. Likes only mark the
+    dashboard dirty; a background thread publishes at most once per `debounce`
+    seconds after likes and every `check_interval` seconds (likes made by other
+    processes are not observed)
+    '''
+
+    def __init__(self, debounce: float, check_interval: float) -> None:
+        self.debounce = debounce
+        self.check_interval = check_interval
+        self.dirty = Event()
+        self.thread: Thread | None = None
+        self.lock = Lock()
+        self.subscribers: dict[tuple[int, int], list[tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        self.snapshots: dict[tuple[int, int], dict] = {}
+
+    def subscribe(
+        self,
+        n: int,
+        k: int,
+        loop: asyncio.AbstractEventLoop,
+    ) -> tuple[asyncio.Queue, dict]:
+        'Returns queue of changes (filled in `loop`) and current dashboard'
+        queue = asyncio.Queue()
+        _, top, last = leaderboard.dashboard(n, k)
+        snapshot = jsonable_encoder({'top': top, 'last': last})
+
+        with self.lock:
+            self.subscribers.setdefault((n, k), []).append((loop, queue))
+            self.snapshots.setdefault((n, k), snapshot)
+            if self.thread is None:
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+        return queue, snapshot
+
+    def unsubscribe(self, n: int, k: int, queue: asyncio.Queue) -> None:
+        with self.lock:
+            subscribers = [
+                subscriber
+                for subscriber in self.subscribers.get((n, k), [])
+                if subscriber[1] is not queue
+            ]
+            if subscribers:
+                self.subscribers[(n, k)] = subscribers
+            else:
+                self.subscribers.pop((n, k), None)
+                self.snapshots.pop((n, k), None)
+
+    def mark_dirty(self, *_) -> None:
+        'Called on likes, must stay cheap: it runs on the like request path'
+        self.dirty.set()
+
+    def _run(self) -> None:
+        while True:
+            if self.dirty.wait(self.check_interval):
+                sleep(self.debounce)  # likes made meanwhile are published at once
+            self.dirty.clear()
+            try:
+                self.publish()
+            except Exception:
+                traceback.print_exc()
+
+    def publish(self) -> None:
+        'Sends changed lists to subscribers'
+        with self.lock:
+            keys = list(self.subscribers)
+
+        for n, k in keys:
+            _, top, last = leaderboard.dashboard(n, k)
+            snapshot = jsonable_encoder({'top': top, 'last': last})
+
+            with self.lock:
+                previous = self.snapshots.get((n, k))
+                if previous is None:
+                    continue  # no subscribers anymore
+                changes = {
+                    name: value
+                    for name, value in snapshot.items()
+                    if previous[name] != value
+                }
+                if not changes:
+                    continue
+                self.snapshots[(n, k)] = snapshot
+                subscribers = list(self.subscribers.get((n, k), []))
+
+            for loop, queue in subscribers:
+                loop.call_soon_threadsafe(queue.put_nowait, changes)
+
+
+dashboard_broadcaster = DashboardBroadcaster(
+    debounce=settings.DASHBOARD_STREAM_DEBOUNCE,
+    check_interval=settings.DASHBOARD_STREAM_KEEPALIVE,
+)
+like_counter.subscribe(dashboard_broadcaster.mark_dirty)
@@ -1,10 +1,78 @@
 import click
+import sqlite3
 import sqlalchemy as sqla
-from sqlalchemy import create_engine, Column
-from sqlalchemy.orm import declarative_base, sessionmaker
+from threading import Lock
+from sqlalchemy import create_engine, event, select, Column
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import declarative_base, sessionmaker, Session
+from sqlalchemy.sql import Select
+from sqlalchemy.pool import QueuePool
+from metrics import instrument_engine
+from settings import settings
 
-engine = create_engine('sqlite:///db.db', echo=False)
+
+def create_db_engine(read_only: bool = False) -> Engine:
+    '''Creates engine for `settings.DB_URL`
+
+    In "production" mode every connection is tuned for concurrent uvicorn workers
+    (WAL journal, busy timeout, mmap and page cache) and kept in a per-process pool.
+    Read-only engine connections are `query_only`, with WAL they never block on writers
+    '''
+    if settings.DB_ENGINE_MODE != 'production':
+        return create_engine(settings.DB_URL, echo=False)
+
+    engine = create_engine(
+        settings.DB_URL,
+        echo=False,
+        poolclass=QueuePool,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_POOL_MAX_OVERFLOW,
+        connect_args={
+            'check_same_thread': False,
+            'timeout': settings.DB_BUSY_TIMEOUT / 1000,
+        },
+    )
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'PRAGMA journal_mode = {settings.DB_JOURNAL_MODE}')
+        cursor.execute(f'PRAGMA synchronous = {settings.DB_SYNCHRONOUS}')
+        cursor.execute(f'PRAGMA busy_timeout = {settings.DB_BUSY_TIMEOUT}')
+        cursor.execute(f'PRAGMA mmap_size = {settings.DB_MMAP_SIZE}')
+        cursor.execute(f'PRAGMA cache_size = {settings.DB_CACHE_SIZE}')
+        if read_only:
+            cursor.execute('PRAGMA query_only = ON')
+        cursor.close()
+
+    return engine
+
+
+engine = create_db_engine()
 DBSession = sessionmaker(engine)
+instrument_engine(engine, 'write')
+
+# for requests that only read, e.g. GET endpoints
+read_engine = create_db_engine(read_only=True)
+ReadDBSession = sessionmaker(read_engine)
+instrument_engine(read_engine, 'read')
+
+
+def pragmas_report() -> dict:
+    'Returns effective pragmas of both engines'
+    pragmas = [
+        'journal_mode', 'synchronous', 'busy_timeout',
+        'mmap_size', 'cache_size', 'query_only',
+    ]
+    report = {}
+    for name, db_engine in [('write', engine), ('read', read_engine)]:
+        with db_engine.connect() as connection:
+            report[name] = {
+                pragma: connection.exec_driver_sql(f'PRAGMA {pragma}').scalar()
+                for pragma in pragmas
+            }
+        report[name]['pool'] = db_engine.pool.status()
+    return report
 
 
 Base = declarative_base()
@@ -19,20 +87,199 @@ class ImageDB(Base):
     image_id = Column(sqla.Integer)
     author_id = Column(sqla.Integer)
     author_name = Column(sqla.String(512))
-    likes_count = Column(sqla.Integer)
+    likes_count = Column(sqla.Integer)  # VK likes and likes made here
+    vk_likes_count = Column(sqla.Integer)  # VK likes on the last sync, NULL for older rows
     url = Column(sqla.String(2048))  # image url
     path = Column(sqla.String(2048))  # file path
     last_update = Column(sqla.DateTime)
 
     __table_args__ = (
         sqla.UniqueConstraint('album_id', 'image_id', name='unique_image'),
+        # album navigation, see explore_images.py
+        sqla.Index('album_position_index', 'album_id', 'album_position'),
+        # dashboard, see leaderboard.py
+        sqla.Index('likes_count_index', 'likes_count'),
+        sqla.Index('last_update_index', 'last_update'),
+    )
+
+
+def as_dict(row: Base) -> dict:
+    'Returns ORM row as a dict with keys in table columns order'
+    return {
+        column.name: getattr(row, column.name)
+        for column in row.__table__.columns
+    }
+
+
+# `images` columns in order of keys of image responses: the order the API had when
+# it returned ORM objects (attributes in load order). New columns go last
+IMAGE_COLUMNS = (
+    ImageDB.author_id,
+    ImageDB.album_position,
+    ImageDB.likes_count,
+    ImageDB.path,
+    ImageDB.id,
+    ImageDB.image_id,
+    ImageDB.album_id,
+    ImageDB.author_name,
+    ImageDB.url,
+    ImageDB.last_update,
+    ImageDB.vk_likes_count,
+)
+
+
+def select_images() -> Select:
+    'SELECT of `images` rows with keys in order of image responses'
+    return select(*IMAGE_COLUMNS)
+
+
+def get_image_row(session: Session, id: int) -> dict | None:
+    'Returns `images` row as a dict without building an ORM instance'
+    row = session.execute(
+        select_images().where(ImageDB.id == id)
+    ).mappings().first()
+    return None if row is None else dict(row)
+
+
+def get_image_rows(session: Session, ids: list[int]) -> list[dict]:
+    'Returns `images` rows in order of `ids` (repeated IDs are repeated, missing are skipped)'
+    rows = {
+        row['id']: row
+        for row in session.execute(
+            select_images().where(ImageDB.id.in_(set(ids)))
+        ).mappings()
+    }
+    return [dict(rows[id]) for id in ids if id in rows]
+
+
+class AlbumCheckpointDB(Base):
+    __tablename__ = 'album_checkpoints'
+
+    album_id = Column(sqla.Integer(), primary_key=True)
+    owner_id = Column(sqla.Integer)
+    offset = Column(sqla.Integer)  # album images synced (with files on disk)
+    count = Column(sqla.Integer)  # album size reported by VK
+    last_update = Column(sqla.DateTime)
+
+
+class ImageFileDB(Base):
+    __tablename__ = 'image_files'
+
+    url = Column(sqla.String(2048), primary_key=True)  # image url
+    sha256 = Column(sqla.String(64), index=True)  # content hash (see storage.py)
+    size = Column(sqla.Integer)
+
+
+class ImageDerivativeDB(Base):
+    __tablename__ = 'image_derivatives'
+
+    image_id = Column(sqla.Integer(), primary_key=True)  # images.id
+    width = Column(sqla.Integer(), primary_key=True)  # one of THUMBNAIL_WIDTHS
+    format = Column(sqla.String(8), primary_key=True)  # see thumbnails.py
+    path = Column(sqla.String(2048))
+    size = Column(sqla.Integer)
+
+
+class ImageHashDB(Base):
+    __tablename__ = 'image_hashes'
+
+    image_id = Column(sqla.Integer(), primary_key=True)  # images.id
+    phash = Column(sqla.BigInteger)  # 64-bit perceptual hash (signed), see duplicates.py
+    duplicate_of = Column(sqla.Integer, index=True)  # images.id of the first copy
+
+
+class JobDB(Base):
+    __tablename__ = 'jobs'
+
+    id = Column(sqla.Integer(), primary_key=True, autoincrement=True)
+    kind = Column(sqla.String(32))  # see jobs.py
+    owner_id = Column(sqla.Integer)
+    album_id = Column(sqla.Integer)
+    params = Column(sqla.JSON)
+    status = Column(sqla.String(32))  # queued, running, done, failed, cancelled
+    cancel_requested = Column(sqla.Boolean, default=False)
+    done = Column(sqla.Integer, default=0)
+    total = Column(sqla.Integer)
+    bytes = Column(sqla.Integer, default=0)
+    errors = Column(sqla.Integer, default=0)
+    result = Column(sqla.JSON)
+    error = Column(sqla.Text)
+    created = Column(sqla.DateTime)
+    updated = Column(sqla.DateTime)  # also a heartbeat of running jobs
+    worker = Column(sqla.String(128))  # process running the job, see jobs.py
+
+    __table_args__ = (
+        # one active job per album, see jobs.py
+        sqla.Index(
+            'active_job_index',
+            'kind', 'album_id',
+            unique=True,
+            sqlite_where=sqla.text("status IN ('queued', 'running')"),
+        ),
     )
 
 
+class DataVersion:
+    '''Detects commits made by other connections (other workers, CLI scripts)
+
+    Uses `PRAGMA data_version` of a dedicated connection, so a check costs no table reads
+    '''
+
+    def __init__(self) -> None:
+        self.connection: sqlite3.Connection | None = None
+        self.version: int | None = None
+        self.lock = Lock()
+
+    def changed(self) -> bool:
+        'Returns True if database was changed since previous call (always on first call)'
+        with self.lock:
+            if self.connection is None:
+                self.connection = sqlite3.connect(
+                    engine.url.database,
+                    check_same_thread=False,
+                )
+            version = self.connection.execute('PRAGMA data_version').fetchone()[0]
+            changed = version != self.version
+            self.version = version
+            return changed
+
+
+def add_missing_columns() -> None:
+    '''Adds (nullable) columns missing in tables created by older versions
+
+    Columns added meanwhile by another process (e.g. API server and a script
+    started together) are skipped
+    '''
+    inspector = sqla.inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            try:
+                with engine.begin() as connection:
+                    connection.exec_driver_sql(
+                        f'ALTER TABLE {table.name} ADD COLUMN {column.name} '
+                        f'{column.type.compile(engine.dialect)}'
+                    )
+            except sqla.exc.OperationalError as error:
+                if 'duplicate column name' not in str(error.orig):
+                    raise
+
+
+def init_db():
+    'Creates missing tables, columns and indexes'
+    Base.metadata.create_all(engine)
+    add_missing_columns()
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
 @click.command()
 def main():
     """Script that creates SQLite database with tables"""
-    Base.metadata.create_all(engine)
+    init_db()
 
 
 if __name__ == '__main__':
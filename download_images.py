@@ -1,108 +1,344 @@
 import click
-from time import sleep
-import requests
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from pathlib import Path
-from sqlalchemy.exc import IntegrityError
-from vk_api import get_images, get_users
-from db import DBSession, ImageDB
+from typing import Callable
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from vk_api import get_images, get_images_pages
+from authors import author_resolver
+from db import DBSession, ImageDB, AlbumCheckpointDB, ImageFileDB, init_db
+from storage import store_image
+from duplicates import duplicate_finder
+from image_cache import image_cache
+from thumbnails import thumbnails
 from settings import settings
 
 
-def images_generator(
+def find_sync_offset(
+    session: Session,
     owner_id: int,
     album_id: int,
+    offset: int,
+) -> tuple[int, dict]:
+    '''Finds the offset to continue album sync from, returns it with the first page
+
+    New photos are appended to the end of an album, so already known images form
+    its prefix. Sync restarts one page before the checkpoint and steps back while
+    the page does not start with a known image (some photos were deleted)
+    '''
+    offset = max(offset - settings.IMAGES_BATCH_SIZE, 0)
+
+    while True:
+        images_info = get_images(
+            owner_id=owner_id,
+            album_id=album_id,
+            offset=offset,
+            count=settings.IMAGES_BATCH_SIZE
+        )
+        if offset == 0:
+            return offset, images_info
+
+        items = images_info['items']
+        if items and session.execute(
+            select(ImageDB.id)
+            .where(ImageDB.album_id == album_id)
+            .where(ImageDB.image_id == items[0]['id'])
+        ).first() is not None:
+            return offset, images_info
+
+        offset = max(
+            min(offset, images_info['count']) - settings.IMAGES_BATCH_SIZE,
+            0
+        )
+
+
+def image_pages_generator(
+    owner_id: int,
+    album_id: int,
+    offset: int,
+    images_info: dict,
     print_info: bool = True,
 ):
-    images_info = get_images(
-        owner_id=owner_id,
-        album_id=album_id,
-        count=0
-    )
+    '''Yields album images page by page starting from `offset` as lists of `images` rows
+
+    `images_info` is the already fetched `photos.get` response for `offset`.
+    Next pages are fetched by one `execute` request per `VK_EXECUTE_BATCH_SIZE`
+    pages, their authors are resolved with (cached) `users.get` calls at once
+    '''
     images_count = images_info["count"]
     signs_count = len(str(images_count))
+    offsets = range(offset, images_count, settings.IMAGES_BATCH_SIZE)
+    pages: deque[list[dict]] = deque([images_info['items']])
 
     if print_info:
         click.echo(f'В альбоме всего {images_count} мемов:')
+        if offset > 0:
+            click.echo(f'Продолжаем синхронизацию с {offset + 1}-го мема')
 
-    batch = []
+    for page_number, offset in enumerate(offsets):
+        if not pages:
+            pages.extend(
+                response['items']
+                for response in get_images_pages(
+                    owner_id=owner_id,
+                    album_id=album_id,
+                    offsets=list(offsets[page_number:page_number + settings.VK_EXECUTE_BATCH_SIZE]),
+                    count=settings.IMAGES_BATCH_SIZE,
+                )
+            )
+            author_resolver.resolve(
+                {image['user_id'] for batch in pages for image in batch}
+            )
+        batch = pages.popleft()
+
+        if not batch:
+            break  # album has shrunk since the first request
+
+        users_names = author_resolver.resolve(
+            {image['user_id'] for image in batch}
+        )
+        page = []
+
+        for i, image in enumerate(batch, start=offset):
+            image_id = image['id']
+            user_id = image['user_id']
+            user_name = users_names.get(user_id, f'id{user_id}')
+            likes_count = image['likes']['count']
+            url = sorted(
+                image['sizes'],
+                key=lambda s: s['height'] * s['width']
+            )[-1]['url']
+            path = f'{settings.IMAGES_PATH}/{album_id}/{image_id}.jpg'
 
-    for i in range(images_count):
-        if i % settings.IMAGES_BATCH_SIZE == 0:
-            batch = get_images(
-                owner_id=owner_id,
+            if print_info:
+                click.echo(
+                    f'({i+1:{signs_count}}/{images_count:{signs_count}}) '
+                    f'{user_name} (https://vk.com/id{user_id}) '
+                    f'получил {likes_count} лайк(-ов) за мем {url}'
+                )
+
+            page.append(dict(
                 album_id=album_id,
-                offset=i,
-                count=settings.IMAGES_BATCH_SIZE
-            )['items']
-
-        image = batch[i % settings.IMAGES_BATCH_SIZE]
-
-        image_id = image['id']
-        user_id = image['user_id']
-        user_info = get_users(users_ids=[user_id])[0]
-        user_name = f'{user_info["first_name"]} {user_info["last_name"]}'
-        likes_count = image['likes']['count']
-        url = sorted(
-            image['sizes'],
-            key=lambda s: s['height'] * s['width']
-        )[-1]['url']
-        path = f'{settings.IMAGES_PATH}/{album_id}/{image_id}.jpg'
-
-        if print_info:
-            click.echo(
-                f'({i+1:{signs_count}}/{images_count:{signs_count}}) '
-                f'{user_name} (https://vk.com/id{user_id}) '
-                f'получил {likes_count} лайк(-ов) за мем {url}'
-            )
+                album_position=i,
+                image_id=image_id,
+                author_id=user_id,
+                author_name=user_name,
+                likes_count=likes_count,
+                vk_likes_count=likes_count,
+                url=url,
+                path=path,
+                last_update=None,
+            ))
 
-        yield ImageDB(
-            album_id=album_id,
-            album_position=i,
-            image_id=image_id,
-            author_id=user_id,
-            author_name=user_name,
-            likes_count=likes_count,
-            url=url,
-            path=path,
+        yield page
+
+
+def save_images_page(session: Session, page: list[dict]) -> list[dict]:
+    '''Inserts a page of images in one transaction skipping already known ones
+
+    Returns only the rows that were actually inserted by this transaction (per-row
+    rowcount, SQLAlchemy 1.4 has no RETURNING for SQLite), so rows inserted
+    concurrently by another writer are not reported as new
+    '''
+    statement = insert(ImageDB).on_conflict_do_nothing(
+        index_elements=['album_id', 'image_id']
+    )
+    inserted = [
+        image
+        for image in page
+        if session.execute(statement, image).rowcount
+    ]
+    session.commit()
+
+    return inserted
+
+
+def save_image_files(session: Session, files: list[dict]) -> None:
+    'Records content hashes of downloaded files'
+    if files:
+        session.execute(
+            insert(ImageFileDB).on_conflict_do_nothing(index_elements=['url']),
+            files,
         )
+        session.commit()
 
 
-def download_images(owner_id: int, album_id: int, print_info: bool):
+def save_checkpoint(
+    session: Session,
+    owner_id: int,
+    album_id: int,
+    offset: int,
+    count: int,
+) -> None:
+    session.merge(AlbumCheckpointDB(
+        album_id=album_id,
+        owner_id=owner_id,
+        offset=offset,
+        count=count,
+        last_update=datetime.now(),
+    ))
+    session.commit()
+
+
+def download_images(
+    owner_id: int,
+    album_id: int,
+    print_info: bool,
+    concurrency: int = settings.DOWNLOAD_CONCURRENCY,
+    full: bool = False,
+    progress: Callable[[dict], None] | None = None,
+) -> dict:
+    '''Downloads album images keeping at most `concurrency` file downloads in flight
+
+    VK API calls are throttled by `vk_api.vk_limiter`, so no extra sleeps are needed.
+    Unless `full` is set, sync continues from the album checkpoint, so interrupted
+    runs are resumed and refreshes fetch only pages that may contain new photos.
+    Failed downloads are counted in `errors` and retried by the next run.
+    `progress` is called with current stats after every page, exceptions raised
+    by it stop the download. Returns numbers of inserted and skipped (already known)
+    images, processed (`done`) and `total` album images, downloaded bytes, errors
+    and new images found to be copies of known ones (see duplicates.py)
+    '''
+    init_db()
     Path(f'{settings.IMAGES_PATH}/{album_id}').mkdir(parents=True, exist_ok=True)
 
-    with DBSession() as session:
-        for image in images_generator(
+    stats = {'inserted': 0, 'skipped': 0, 'done': 0, 'total': 0, 'bytes': 0, 'errors': 0}
+    in_flight: set[Future] = set()
+    stored_files: list[dict] = []
+    # (offset after page, page downloads) for pages not yet covered by checkpoint
+    pending_pages: deque[tuple[int, list[Future]]] = deque()
+
+    def collect(done: set[Future]) -> None:
+        for future in done:
+            if (error := future.exception()) is not None:
+                stats['errors'] += 1
+                if print_info:
+                    click.echo(f'Не удалось скачать изображение: {error}', err=True)
+            elif (file := future.result()) is not None:
+                stored_files.append(file)
+                stats['bytes'] += file['size']
+
+    def advance_checkpoint() -> bool:
+        'Moves checkpoint past leading pages with all files downloaded'
+        nonlocal checkpoint_offset
+        advanced = False
+        while pending_pages and all(
+            f.done() and f.exception() is None for f in pending_pages[0][1]
+        ):
+            checkpoint_offset, _ = pending_pages.popleft()
+            advanced = True
+        return advanced
+
+    with DBSession() as session, ThreadPoolExecutor(max(concurrency, 1)) as executor:
+        checkpoint: AlbumCheckpointDB | None = session.get(AlbumCheckpointDB, album_id)
+        offset, images_info = find_sync_offset(
+            session=session,
             owner_id=owner_id,
             album_id=album_id,
+            offset=0 if full or checkpoint is None else checkpoint.offset,
+        )
+        images_count = images_info['count']
+        checkpoint_offset = offset
+        stats['total'] = images_count
+        stats['done'] = offset
+
+        for page in image_pages_generator(
+            owner_id=owner_id,
+            album_id=album_id,
+            offset=offset,
+            images_info=images_info,
             print_info=print_info,
         ):
-            try:
-                session.add(image)
-                session.flush()
-                session.commit()
-            except IntegrityError:
-                session.rollback()
-                if print_info:
-                    click.echo('Данное изображение уже есть в базе')
-            else:
-                img = requests.get(image.url).content
-                with open(image.path, 'wb') as f:
-                    f.write(img)
+            new_images = save_images_page(session, page)
+            if new_images:
+                image_cache.invalidate_album(album_id)
+            stats['inserted'] += len(new_images)
+            stats['skipped'] += len(page) - len(new_images)
+
+            if print_info and len(new_images) < len(page):
+                click.echo(
+                    f'{len(page) - len(new_images)} изображений из страницы уже есть в базе'
+                )
+
+            known_hashes = dict(
+                session.execute(
+                    select(ImageFileDB.url, ImageFileDB.sha256)
+                    .where(ImageFileDB.url.in_([image['url'] for image in page]))
+                ).all()
+            )
+            new_ids = {image['image_id'] for image in new_images}
+            page_downloads = []
+            for image in page:
+                # files of known images may be missing after an interrupted run
+                if image['image_id'] not in new_ids and Path(image['path']).exists():
+                    continue
+
+                if len(in_flight) >= concurrency:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                future = executor.submit(
+                    store_image,
+                    image['url'],
+                    image['path'],
+                    known_hashes.get(image['url']),
+                )
+                in_flight.add(future)
+                page_downloads.append(future)
+
+            done = {future for future in in_flight if future.done()}
+            in_flight -= done
+            collect(done)
+            save_image_files(session, stored_files)
+            stored_files.clear()
+
+            stats['done'] = page[-1]['album_position'] + 1
+            pending_pages.append((stats['done'], page_downloads))
+            if advance_checkpoint():
+                save_checkpoint(session, owner_id, album_id, checkpoint_offset, images_count)
+
+            if progress is not None:
+                progress(stats)
+
+        wait(in_flight)
+        collect(in_flight)
+        save_image_files(session, stored_files)
+        advance_checkpoint()
+        save_checkpoint(session, owner_id, album_id, checkpoint_offset, images_count)
+
+        stats['duplicates'] = duplicate_finder.hash_images(album_id=album_id, executor=executor)
+
+    if print_info:
+        click.echo(
+            f'Добавлено изображений: {stats["inserted"]}, '
+            f'пропущено (уже есть в базе): {stats["skipped"]}'
+            + (f', ошибок загрузки: {stats["errors"]}' if stats['errors'] else '')
+            + (f', найдено копий уже известных изображений: {stats["duplicates"]}' if stats['duplicates'] else '')
+        )
 
-            sleep(0.25)  # antiDDOS
+    return stats
 
 
 @click.command()
 @click.option("--owner-id", default=-197700721, show_default=True, help="ID владельца альбома")
 @click.option("--album-id", default=281940823, show_default=True, help="ID альбома")
+@click.option("--concurrency", default=settings.DOWNLOAD_CONCURRENCY, type=click.IntRange(min=1), show_default=True, help="Число одновременных загрузок изображений")
+@click.option("--full", default=False, is_flag=True, help="Пройти весь альбом, игнорируя сохраненный прогресс")
+@click.option("--thumbnails", "make_thumbnails", default=False, is_flag=True, help="Создать уменьшенные копии изображений после загрузки")
 @click.option("--no-print-info", default=False, is_flag=True, help="Скрыть доп. информацию с консоли")
-def main(owner_id: int, album_id: int, no_print_info: bool):
+def main(owner_id: int, album_id: int, concurrency: int, full: bool, make_thumbnails: bool, no_print_info: bool):
     """Script that downloads images"""
     download_images(
         owner_id=owner_id,
         album_id=album_id,
-        print_info=not no_print_info
+        print_info=not no_print_info,
+        concurrency=concurrency,
+        full=full,
     )
+    if make_thumbnails:
+        thumbnails.generate(album_id=album_id, print_info=not no_print_info)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,365 @@
+import click
+import numpy as np
+from concurrent.futures import Executor, ThreadPoolExecutor
+from itertools import combinations
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+from PIL import Image
+from sqlalchemy import select, update, func
+from sqlalchemy.dialects.sqlite import insert
+from db import DBSession, ImageDB, ImageHashDB, DataVersion, init_db
+from image_cache import image_cache
+from settings import settings
+
+HASH_SIZE = 8  # dHash of 8x8 gradients, 64 bits
+CHUNKS = 4  # multi-index: hashes are split into 4 chunks of 16 bits
+CHUNK_BITS = 64 // CHUNKS
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def image_hash(path: str) -> int:
+    '''Returns 64-bit difference hash (dHash) of the image as a signed integer
+
+    Similar images (recompressed, resized, slightly edited) have hashes differing
+    in a few bits
+    '''
+    with Image.open(path) as image:
+        image.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))  # fast downscaled JPEG decoding
+        pixels = np.asarray(
+            image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS),
+            dtype=np.int16,
+        )
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int(np.packbits(bits).view('>i8')[0])
+
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    'Number of set bits of every uint64'
+    if hasattr(np, 'bitwise_count'):  # NumPy 2.0+
+        return np.bitwise_count(values)
+    return POPCOUNT[values.view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+
+def chunk_masks(radius: int) -> np.ndarray:
+    'All chunk values with at most `radius` bits set'
+    return np.array(
+        [
+            sum(1 << bit for bit in bits)
+            for r in range(radius + 1)
+            for bits in combinations(range(CHUNK_BITS), r)
+        ],
+        dtype=np.uint16,
+    )
+
+
+class HashIndex:
+    '''Hamming distance index of 64-bit hashes
+
+    Hashes are kept in a NumPy array and compared with vectorized XOR and popcount.
+    By pigeonhole principle hashes within distance `d` have a 16-bit chunk that
+    differs in at most `d // 4` bits, so for small distances only hashes with such
+    chunks (found by binary search in sorted chunk arrays) are compared. Added
+    hashes are kept in a small unsorted buffer until the next rebuild
+    '''
+
+    def __init__(self, ids: list[int], hashes: list[int]) -> None:
+        self.pending_ids: list[int] = []
+        self.pending_hashes: list[int] = []
+        self._build(np.array(ids, dtype=np.int64), np.array(hashes, dtype=np.int64).view(np.uint64))
+
+    def _build(self, ids: np.ndarray, hashes: np.ndarray) -> None:
+        self.ids = ids
+        self.hashes = hashes
+        self.chunks = []
+        for chunk in range(CHUNKS):
+            values = ((hashes >> np.uint64(chunk * CHUNK_BITS)) & np.uint64(0xFFFF)).astype(np.uint16)
+            order = np.argsort(values, kind='stable')
+            self.chunks.append((values[order], order))
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.pending_ids)
+
+    def add(self, id: int, phash: int) -> None:
+        self.pending_ids.append(id)
+        self.pending_hashes.append(phash)
+        if len(self.pending_ids) > 4096:
+            self._build(
+                np.concatenate([self.ids, np.array(self.pending_ids, dtype=np.int64)]),
+                np.concatenate([self.hashes, np.array(self.pending_hashes, dtype=np.int64).view(np.uint64)]),
+            )
+            self.pending_ids = []
+            self.pending_hashes = []
+
+    def _candidates(self, phash: np.uint64, max_distance: int) -> np.ndarray:
+        radius = max_distance // CHUNKS
+        if radius > 2:  # too many probes, compare with all hashes
+            return np.arange(len(self.ids))
+
+        masks = chunk_masks(radius)
+        candidates = []
+        for chunk, (values, order) in enumerate(self.chunks):
+            probes = np.uint16((phash >> np.uint64(chunk * CHUNK_BITS)) & np.uint64(0xFFFF)) ^ masks
+            starts = np.searchsorted(values, probes, side='left')
+            ends = np.searchsorted(values, probes, side='right')
+            candidates.extend(order[start:end] for start, end in zip(starts, ends) if end > start)
+        if not candidates:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(candidates))
+
+    def search(self, phash: int, max_distance: int) -> list[tuple[int, int]]:
+        'Returns (distance, id) of hashes within `max_distance` bits, nearest first'
+        query = np.array([phash], dtype=np.int64).view(np.uint64)[0]
+
+        candidates = self._candidates(query, max_distance)
+        ids = self.ids[candidates]
+        distances = popcount(self.hashes[candidates] ^ query)
+        if self.pending_ids:
+            ids = np.concatenate([ids, np.array(self.pending_ids, dtype=np.int64)])
+            distances = np.concatenate([
+                distances,
+                popcount(np.array(self.pending_hashes, dtype=np.int64).view(np.uint64) ^ query),
+            ])
+
+        found = distances <= max_distance
+        return sorted(zip(distances[found].tolist(), ids[found].tolist()))
+
+
+class DuplicateFinder:
+    '''Finds copies of images (same meme re-uploaded or in other albums)
+
+    Perceptual hashes are computed at ingestion and stored in `image_hashes`, an
+    image within `max_distance` bits of a known one is recorded as its copy
+    (`duplicate_of` is the first copy). When the database was changed by other
+    connections, hashes with greater image IDs than the loaded ones are added to
+    the index at once. The index is fully reloaded (to get hashes of older images
+    and merged copies) at most once per `reload_interval` seconds
+    '''
+
+    def __init__(self, max_distance: int, reload_interval: float) -> None:
+        self.max_distance = max_distance
+        self.reload_interval = reload_interval
+        self.data_version = DataVersion()
+        self.lock = Lock()
+        self.index: HashIndex | None = None
+        self.duplicate_of: dict[int, int] = {}
+        self.last_id = 0  # greatest image ID in the index
+        self.loaded_at = 0.0
+        self.stale = False  # changed by other connections since the full load
+
+    def _load(self) -> None:
+        with DBSession() as session:
+            rows = session.execute(
+                select(ImageHashDB.image_id, ImageHashDB.phash, ImageHashDB.duplicate_of)
+                .order_by(ImageHashDB.image_id)
+            ).all()
+
+        self.index = HashIndex([id for id, _, _ in rows], [phash for _, phash, _ in rows])
+        self.duplicate_of = {id: duplicate_of for id, _, duplicate_of in rows if duplicate_of is not None}
+        self.last_id = rows[-1][0] if rows else 0
+        self.loaded_at = monotonic()
+        self.stale = False
+
+    def _load_new(self) -> None:
+        with DBSession() as session:
+            rows = session.execute(
+                select(ImageHashDB.image_id, ImageHashDB.phash, ImageHashDB.duplicate_of)
+                .where(ImageHashDB.image_id > self.last_id)
+                .order_by(ImageHashDB.image_id)
+            ).all()
+
+        for id, phash, duplicate_of in rows:
+            self.index.add(id, phash)
+            if duplicate_of is not None:
+                self.duplicate_of[id] = duplicate_of
+        if rows:
+            self.last_id = rows[-1][0]
+
+    def _refresh(self) -> None:
+        if self.index is None:
+            self.data_version.changed()
+            self._load()
+            return
+        if self.data_version.changed():
+            self.stale = True
+            self._load_new()
+        if self.stale and monotonic() - self.loaded_at >= self.reload_interval:
+            self._load()
+
+    def _first_copy(self, phash: int) -> int | None:
+        # nearest image that is not a copy itself, as in `clusters`
+        return next(
+            (id for _, id in self.index.search(phash, self.max_distance) if id not in self.duplicate_of),
+            None,
+        )
+
+    def hash_images(self, album_id: int | None = None, executor: Executor | None = None) -> int:
+        'Hashes stored images without hashes (of the album or all), returns number of found copies'
+        with DBSession() as session:
+            query = (
+                select(ImageDB.id, ImageDB.path)
+                .outerjoin(ImageHashDB, ImageHashDB.image_id == ImageDB.id)
+                .where(ImageHashDB.image_id.is_(None))
+                .order_by(ImageDB.id)
+            )
+            if album_id is not None:
+                query = query.where(ImageDB.album_id == album_id)
+            images = [(id, path) for id, path in session.execute(query).all() if Path(path).exists()]
+            if not images:
+                return 0
+
+            def safe_hash(path: str) -> int | None:
+                try:
+                    return image_hash(path)
+                except Exception:
+                    return None  # broken file, will be retried by the next run
+
+            if executor is None:
+                with ThreadPoolExecutor() as own_executor:
+                    hashes = list(own_executor.map(safe_hash, [path for _, path in images]))
+            else:
+                hashes = list(executor.map(safe_hash, [path for _, path in images]))
+
+            rows = []
+            with self.lock:
+                self._refresh()
+                for (id, _), phash in zip(images, hashes):
+                    if phash is None:
+                        continue
+                    duplicate_of = self._first_copy(phash)
+                    if duplicate_of is not None:
+                        self.duplicate_of[id] = duplicate_of
+                    self.index.add(id, phash)
+                    rows.append({'image_id': id, 'phash': phash, 'duplicate_of': duplicate_of})
+
+                if rows:
+                    session.execute(
+                        insert(ImageHashDB).on_conflict_do_nothing(index_elements=['image_id']),
+                        rows,
+                    )
+                    session.commit()
+                    # our rows are already in the index, hashes of other connections
+                    # with smaller IDs are loaded by the next full reload
+                    self.last_id = max(self.last_id, rows[-1]['image_id'])
+                    self.stale = True
+
+        return sum(row['duplicate_of'] is not None for row in rows)
+
+    def clusters(self) -> list[list[tuple[int, int]]]:
+        '''Returns groups of copies, each as (distance to the first copy, id) sorted by id
+
+        Every image joins the group of the nearest earlier image within `max_distance`
+        bits that is not a copy itself, so copies are never chained far away from
+        the first copy
+        '''
+        with self.lock:
+            self._refresh()
+            index = self.index
+            ids = index.ids.tolist() + index.pending_ids
+            hashes = index.hashes.view(np.int64).tolist() + index.pending_hashes
+
+            groups: dict[int, list[tuple[int, int]]] = {}
+            for id, phash in sorted(zip(ids, hashes)):
+                first = next(
+                    (
+                        (distance, other)
+                        for distance, other in index.search(phash, self.max_distance)
+                        if other < id and other in groups
+                    ),
+                    None,
+                )
+                if first is None:
+                    groups[id] = [(0, id)]
+                else:
+                    groups[first[1]].append((first[0], id))
+
+        return [group for _, group in sorted(groups.items()) if len(group) > 1]
+
+
+def merge_duplicates(clusters: list[list[tuple[int, int]]]) -> int:
+    '''Moves likes of copies to the first copy of every group, returns moved likes
+
+    Copies keep their rows (and album positions) with zero likes. Likes made to
+    copies later are moved by the next merge
+    '''
+    images = ImageDB.__table__
+    moved = 0
+
+    with DBSession() as session:
+        for cluster in clusters:
+            (_, first), *copies = cluster
+            copies_ids = [id for _, id in copies]
+
+            likes_count, last_update = session.execute(
+                select(func.sum(images.c.likes_count), func.max(images.c.last_update))
+                .where(images.c.id.in_(copies_ids))
+            ).one()
+            if likes_count:
+                session.execute(
+                    update(images)
+                    .where(images.c.id == first)
+                    .values(
+                        likes_count=func.coalesce(images.c.likes_count, 0) + likes_count,
+                        last_update=func.max(func.coalesce(images.c.last_update, last_update), last_update),
+                    )
+                )
+                session.execute(
+                    update(images)
+                    .where(images.c.id.in_(copies_ids))
+                    .values(likes_count=0)
+                )
+                moved += likes_count
+
+            session.execute(
+                update(ImageHashDB)
+                .where(ImageHashDB.image_id.in_(copies_ids))
+                .values(duplicate_of=first)
+            )
+            session.execute(
+                update(ImageHashDB)
+                .where(ImageHashDB.image_id == first)
+                .values(duplicate_of=None)
+            )
+        session.commit()
+
+    image_cache.invalidate_images([id for cluster in clusters for _, id in cluster])
+    return moved
+
+
+duplicate_finder = DuplicateFinder(
+    max_distance=settings.DUPLICATES_MAX_DISTANCE,
+    reload_interval=settings.DUPLICATES_RELOAD_SECONDS,
+)
+
+
+@click.command()
+@click.option("--max-distance", default=settings.DUPLICATES_MAX_DISTANCE, type=click.IntRange(0, 64), show_default=True, help="Максимальное число различающихся бит хешей копий")
+@click.option("--merge", default=False, is_flag=True, help="Перенести лайки копий на первую копию")
+def main(max_distance: int, merge: bool):
+    """Script that reports (and merges) copies of images"""
+    init_db()
+    duplicate_finder.max_distance = max_distance
+    duplicate_finder.hash_images()
+    clusters = duplicate_finder.clusters()
+
+    with DBSession() as session:
+        urls = dict(
+            session.execute(
+                select(ImageDB.id, ImageDB.url)
+                .where(ImageDB.id.in_([id for cluster in clusters for _, id in cluster]))
+            ).all()
+        )
+
+    for (_, first), *copies in clusters:
+        click.echo(f'{first}: {urls[first]}')
+        for distance, id in copies:
+            click.echo(f'    {id} (отличается бит: {distance}): {urls[id]}')
+
+    click.echo(f'Групп копий: {len(clusters)}, копий: {sum(len(cluster) - 1 for cluster in clusters)}')
+
+    if merge:
+        click.echo(f'Перенесено лайков: {merge_duplicates(clusters)}')
+
+
+if __name__ == '__main__':
+    main()
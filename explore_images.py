@@ -1,12 +1,12 @@
 import random
 import click
-from datetime import datetime
 from sqlalchemy.sql import text
-from db import DBSession, ImageDB
+from db import ReadDBSession, ImageDB
+from likes import like_counter
 
 
 def get_first_image_in_album(album_id: int) -> int:
-    with DBSession() as session:
+    with ReadDBSession() as session:
         return session.execute(
             text('''
             SELECT 
@@ -16,7 +16,7 @@ def get_first_image_in_album(album_id: int) -> int:
             WHERE 
                 album_id = :album_id
             ORDER BY 
-                album_position
+                album_position, id
             LIMIT 1
             '''),
             {'album_id': album_id}
@@ -24,23 +24,41 @@ def get_first_image_in_album(album_id: int) -> int:
 
 
 def next_image_in_album(id: int) -> int:
-    'Returns next image ID (returns first after last)'
-    with DBSession() as session:
+    '''Returns next image ID (returns first after last)
+
+    Both lookups are seeks on `album_position_index`, so they do not depend on table size
+    '''
+    with ReadDBSession() as session:
         return session.execute(
             text('''
             SELECT 
-                next_id
-            FROM (
-                SELECT
-                    id as id,
-                    COALESCE(
-                        LEAD(id) OVER (PARTITION BY album_id ORDER BY album_position),
-                        FIRST_VALUE(id) OVER (PARTITION BY album_id ORDER BY album_position)
-                    ) AS next_id,
-                    album_id AS album_id 
-                FROM 
-                    images i 
-            ) s
+                COALESCE(
+                    (
+                        SELECT
+                            n.id
+                        FROM
+                            images n
+                        WHERE
+                            n.album_id = i.album_id
+                            AND (n.album_position, n.id) > (i.album_position, i.id)
+                        ORDER BY
+                            n.album_position, n.id
+                        LIMIT 1
+                    ),
+                    (
+                        SELECT
+                            f.id
+                        FROM
+                            images f
+                        WHERE
+                            f.album_id = i.album_id
+                        ORDER BY
+                            f.album_position, f.id
+                        LIMIT 1
+                    )
+                ) AS next_id
+            FROM 
+                images i 
             WHERE 
                 id = :id
             '''),
@@ -86,13 +104,13 @@ def main(album_id: int):
 
     questions = question_generator()
 
-    with DBSession() as session:
+    with ReadDBSession() as session:
         while True:
             image: ImageDB = session.query(
                 ImageDB
             ).where(
                 ImageDB.id == image_id
-            ).first()
+            ).populate_existing().first()  # likes are written by like_counter
             image_id = next_image_in_album(image_id)
 
             command = click.prompt(
@@ -101,7 +119,7 @@ def main(album_id: int):
                     f'{next(questions)}\n'
                     f'Ссылка: {image.url}\n'
                     f'Автор: {image.author_name}\n'
-                    f'Число лайков: {image.likes_count}\n'
+                    f'Число лайков: {image.likes_count + like_counter.pending(image.id)}\n'
                     f'Вы решаете:'
                 ),
                 default='skip',
@@ -111,10 +129,7 @@ def main(album_id: int):
             )
             match command:
                 case 'like':
-                    image.likes_count += 1
-                    image.last_update = datetime.now()
-                    session.flush()
-                    session.commit()
+                    like_counter.like(image.id)
                 case 'skip':
                     pass
                 case 'quit':
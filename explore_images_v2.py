@@ -1,41 +1,56 @@
 import click
-from datetime import datetime
-from sqlalchemy.sql import text
-from db import DBSession, ImageDB
+from db import ReadDBSession, ImageDB
+from likes import like_counter
+from sampler import weighted_sampler, sample_prefetcher
+from sessions import SeenFilter
 from explore_images import question_generator
+from settings import settings
 
 
-def next_image(favourite_id: int, id: int = -1) -> int:
-    'Returns next random image ID'
-    with DBSession() as session:
-        return session.execute(
-            text('''
-            SELECT
-                id 
-            FROM (
-                SELECT 
-                    s.*,
-                    sum(p) over (ORDER BY id) > r.r % sum(p) over () as f
-                FROM (
-                    SELECT 
-                        id,
-                        likes_count,
-                        case 
-                            when id == :favourite_id then (sum(likes_count + 1) over () - likes_count - 1)
-                            else likes_count + 1
-                        end as p
-                    from images i 
-                    where id <> :id
-                ) s, (
-                    SELECT ABS(RANDOM()) as r
-                ) r
-            ) ss
-            WHERE f
-            ORDER BY id
-            limit 1
-            '''),
-            {'id': id, 'favourite_id': favourite_id}
-        ).scalar()
+def next_images(
+    favourite_id: int,
+    id: int = -1,
+    count: int = 1,
+    seen: SeenFilter | None = None,
+) -> list[int]:
+    '''Returns up to `count` next random image IDs (none if there are no images)
+
+    Without `seen` IDs are taken from the prefetch buffer of the favourite. With
+    `seen` images already shown in the exploration session are skipped (except
+    the favourite), when almost everything is seen the session starts over
+    '''
+    if seen is None:
+        return sample_prefetcher.take(favourite_id=favourite_id, id=id, count=count)
+
+    next_ids = weighted_sampler.sample_many(
+        favourite_id=favourite_id,
+        id=id,
+        count=count,
+        exclude=seen,
+        attempts=settings.EXPLORE_REJECTION_ATTEMPTS,
+    )
+    if len(next_ids) < count:
+        seen.clear()
+        for next_id in next_ids:
+            if next_id != favourite_id:
+                seen.add(next_id)
+        next_ids += weighted_sampler.sample_many(
+            favourite_id=favourite_id,
+            id=next_ids[-1] if next_ids else id,
+            count=count - len(next_ids),
+            exclude=seen,
+            attempts=settings.EXPLORE_REJECTION_ATTEMPTS,
+        )
+    for next_id in next_ids:
+        if next_id != favourite_id:
+            seen.add(next_id)
+    return next_ids
+
+
+def next_image(favourite_id: int, id: int = -1, seen: SeenFilter | None = None) -> int | None:
+    'Returns next random image ID (None if there are no images), see `next_images`'
+    next_ids = next_images(favourite_id=favourite_id, id=id, seen=seen)
+    return next_ids[0] if next_ids else None
 
 
 @click.command()
@@ -47,20 +62,22 @@ def main():
         type=int,
         default=1
     )
-    image_id = next_image(favourite_id=favourite_id)
+    seen = SeenFilter(settings.EXPLORE_SESSION_BITS, settings.EXPLORE_SESSION_HASHES)
+    image_id = next_image(favourite_id=favourite_id, seen=seen)
 
     questions = question_generator()
 
-    with DBSession() as session:
+    with ReadDBSession() as session:
         while True:
             image: ImageDB = session.query(
                 ImageDB
             ).where(
                 ImageDB.id == image_id
-            ).first()
+            ).populate_existing().first()  # likes are written by like_counter
             image_id = next_image(
                 favourite_id=favourite_id,
                 id=image_id,
+                seen=seen,
             )
 
             command = click.prompt(
@@ -70,7 +87,7 @@ def main():
                     f'ID: {image.id}\n'
                     f'Ссылка: {image.url}\n'
                     f'Автор: {image.author_name}\n'
-                    f'Число лайков: {image.likes_count}\n'
+                    f'Число лайков: {image.likes_count + like_counter.pending(image.id)}\n'
                     f'Вы решаете:'
                 ),
                 default='skip',
@@ -80,10 +97,7 @@ def main():
             )
             match command:
                 case 'like':
-                    image.likes_count += 1
-                    image.last_update = datetime.now()
-                    session.flush()
-                    session.commit()
+                    like_counter.like(image.id)
                 case 'skip':
                     pass
                 case 'quit':
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Hashable
+from db import ReadDBSession, get_image_row
+from explore_images import get_first_image_in_album, next_image_in_album
+from likes import like_counter
+from metrics import cache_lookups
+from settings import settings
+
+MISSING = object()
+
+
+class LRUCache:
+    '''Thread-safe read-through LRU cache with entries expiring after `ttl` seconds
+
+    Values are loaded outside of the lock, so concurrent misses of one key may load
+    it twice. A value whose key was invalidated during loading is returned but
+    not stored, as it may have been read before the change
+    '''
+
+    def __init__(self, name: str, max_size: int, ttl: float) -> None:
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+        self.loading: dict[Hashable, int] = {}  # key -> number of loads in progress
+        self.stale: set[Hashable] = set()  # keys invalidated during loading
+        self.lock = Lock()
+
+    def get(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        now = monotonic()
+        with self.lock:
+            value, expires = self.entries.get(key, (MISSING, 0.0))
+            if value is not MISSING and expires >= now:
+                self.entries.move_to_end(key)
+            else:
+                value = MISSING
+                self.loading[key] = self.loading.get(key, 0) + 1
+
+        if value is not MISSING:
+            cache_lookups.labels(self.name, 'hit').inc()
+            return value
+
+        cache_lookups.labels(self.name, 'miss').inc()
+        try:
+            value = load()
+        except BaseException:
+            with self.lock:
+                self._finish_loading(key)
+            raise
+
+        with self.lock:
+            if key not in self.stale:
+                self.entries[key] = (value, now + self.ttl)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+            self._finish_loading(key)
+        return value
+
+    def _finish_loading(self, key: Hashable) -> None:
+        self.loading[key] -= 1
+        if self.loading[key] == 0:
+            del self.loading[key]
+            self.stale.discard(key)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+            if key in self.loading:
+                self.stale.add(key)
+
+    def invalidate_where(self, predicate: Callable[[Hashable, Any], bool]) -> None:
+        'Invalidates entries matching `predicate(key, value)` and all loads in progress'
+        with self.lock:
+            for key in [key for key, (value, _) in self.entries.items() if predicate(key, value)]:
+                del self.entries[key]
+            self.stale.update(self.loading)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.stale.update(self.loading)
+
+
+class ImageCache:
+    '''Caches of album navigation (first image of an album, next image of an image)
+    and of image rows with pending likes applied
+
+    A like invalidates the row of the image, and so does the flush writing it
+    (a row being loaded meanwhile may have missed it both in the database and in
+    pending likes). Ingestion of an album invalidates its navigation and missing
+    rows. Changes made by other processes are seen after at most `IMAGE_CACHE_TTL`
+    seconds
+    '''
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.first_images = LRUCache('first_image_in_album', max_size, ttl)
+        # image ID -> (album ID, next image ID), (None, None) for unknown images
+        self.next_images = LRUCache('next_image_in_album', max_size, ttl)
+        self.rows = LRUCache('image', max_size, ttl)
+
+    def _load_image(self, id: int) -> dict | None:
+        with ReadDBSession() as session:
+            image = get_image_row(session, id)
+        return None if image is None else like_counter.merge(image)
+
+    def get_image(self, id: int) -> dict | None:
+        'Returns image with pending likes applied'
+        return self.rows.get(id, lambda: self._load_image(id))
+
+    def first_image_in_album(self, album_id: int) -> int | None:
+        return self.first_images.get(album_id, lambda: get_first_image_in_album(album_id))
+
+    def _load_next_image(self, id: int) -> tuple[int | None, int | None]:
+        next_id = next_image_in_album(id)
+        if next_id is None:
+            return None, None
+        image = self.get_image(next_id)  # needed for the response anyway
+        return (None if image is None else image['album_id']), next_id
+
+    def next_image_in_album(self, id: int) -> int | None:
+        'Returns next image ID (returns first after last)'
+        _, next_id = self.next_images.get(id, lambda: self._load_next_image(id))
+        return next_id
+
+    def add_likes(self, id: int, delta: int = 1) -> None:
+        self.rows.invalidate(id)
+
+    def invalidate_flushed(self, ids: list[int]) -> None:
+        for id in ids:
+            self.rows.invalidate(id)
+
+    def invalidate_images(self, ids: list[int]) -> None:
+        'Invalidates rows changed other than by likes'
+        ids = set(ids)
+        self.rows.invalidate_where(lambda id, _: id in ids)
+
+    def invalidate_album(self, album_id: int) -> None:
+        'Invalidates navigation of the album and unknown images after new images were added to it'
+        self.first_images.invalidate(album_id)
+        self.next_images.invalidate_where(lambda _, value: value[0] in (album_id, None))
+        self.rows.invalidate_where(lambda _, image: image is None)
+
+
+image_cache = ImageCache(max_size=settings.IMAGE_CACHE_SIZE, ttl=settings.IMAGE_CACHE_TTL)
+like_counter.subscribe(image_cache.add_likes)
+like_counter.subscribe_flush(image_cache.invalidate_flushed)
@@ -0,0 +1,270 @@
+import os
+import socket
+import traceback
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+from time import sleep
+from uuid import uuid4
+from typing import Callable
+from sqlalchemy import select, update
+from sqlalchemy.dialects.sqlite import insert
+from db import DBSession, ReadDBSession, JobDB, as_dict
+from download_images import download_images
+from thumbnails import thumbnails
+from refresh_images import refresh_images
+from settings import settings
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def process_alive(pid: int) -> bool:
+    'Checks that a process of this host exists (always True where it can not be checked)'
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # process of another user
+    return True
+
+
+def run_download(job: dict, progress: Callable[[dict], None]) -> dict:
+    params = dict(job['params'])
+    make_thumbnails = params.pop('thumbnails', False)
+    stats = download_images(
+        owner_id=job['owner_id'],
+        album_id=job['album_id'],
+        print_info=False,
+        progress=progress,
+        **params,
+    )
+    if make_thumbnails:
+        stats['thumbnails'] = thumbnails.generate(album_id=job['album_id'])
+    return stats
+
+
+def run_thumbnails(job: dict, progress: Callable[[dict], None]) -> dict:
+    return thumbnails.generate(album_id=job['album_id'], progress=progress)
+
+
+def run_refresh(job: dict, progress: Callable[[dict], None]) -> dict:
+    return refresh_images(owner_id=job['owner_id'], album_id=job['album_id'], progress=progress)
+
+
+class JobQueue:
+    '''Background jobs (album ingestion, thumbnails, refresh) executed by a thread pool
+
+    Jobs are stored in the `jobs` table, so their state survives restarts. There
+    is at most one active job of a kind per album, requests for an album with an
+    active job get that job. Every process executes only jobs it claimed by
+    switching them from "queued" to "running" and records itself as their
+    `worker` ("<host>:<pid>:<token>").
+
+    `resume` schedules queued jobs and starts a thread that every `sweep_interval`
+    seconds re-queues orphaned running jobs: jobs of dead processes of this host
+    (a restarted process with the same PID has another token) and jobs of other
+    hosts without heartbeat for `stale_after` seconds
+    '''
+
+    def __init__(self, workers: int, stale_after: float, sweep_interval: float) -> None:
+        self.executor = ThreadPoolExecutor(workers)
+        self.stale_after = stale_after
+        self.sweep_interval = sweep_interval
+        self.host = socket.gethostname()
+        self.worker = f'{self.host}:{os.getpid()}:{uuid4().hex[:8]}'
+        self.thread: Thread | None = None
+        self.lock = Lock()
+        self.runners: dict[str, Callable[[dict, Callable[[dict], None]], dict]] = {
+            'download': run_download,
+            'thumbnails': run_thumbnails,
+            'refresh': run_refresh,
+        }
+
+    def enqueue(self, kind: str, owner_id: int | None, album_id: int, params: dict) -> dict:
+        'Creates job (or returns active job for the album) and schedules it'
+        now = datetime.now()
+        with DBSession() as session:
+            created = session.execute(
+                insert(JobDB)
+                .values(
+                    kind=kind,
+                    owner_id=owner_id,
+                    album_id=album_id,
+                    params=params,
+                    status='queued',
+                    cancel_requested=False,
+                    done=0,
+                    bytes=0,
+                    errors=0,
+                    created=now,
+                    updated=now,
+                )
+                .on_conflict_do_nothing(
+                    index_elements=['kind', 'album_id'],
+                    index_where=JobDB.status.in_(ACTIVE_STATUSES),
+                )
+            ).rowcount
+            session.commit()
+
+            job = as_dict(
+                session.execute(
+                    select(JobDB)
+                    .where(JobDB.kind == kind)
+                    .where(JobDB.album_id == album_id)
+                    .where(JobDB.status.in_(ACTIVE_STATUSES))
+                ).scalar_one()
+            )
+
+        if created:
+            self.executor.submit(self.run, job['id'])
+        return job
+
+    def get(self, id: int) -> dict | None:
+        with ReadDBSession() as session:
+            job = session.get(JobDB, id)
+            return None if job is None else as_dict(job)
+
+    def cancel(self, id: int) -> dict | None:
+        'Requests job cancellation, running job stops after the current page'
+        with DBSession() as session:
+            session.execute(
+                update(JobDB)
+                .where(JobDB.id == id)
+                .where(JobDB.status.in_(ACTIVE_STATUSES))
+                .values(cancel_requested=True, updated=datetime.now())
+            )
+            session.execute(
+                update(JobDB)
+                .where(JobDB.id == id)
+                .where(JobDB.status == 'queued')
+                .values(status='cancelled')
+            )
+            session.commit()
+            job = session.get(JobDB, id)
+            return None if job is None else as_dict(job)
+
+    def is_orphaned(self, worker: str | None, updated: datetime) -> bool:
+        'Checks that a running job is not executed by any process anymore'
+        if worker == self.worker:
+            return False
+        host, pid, _ = (worker or '::').rsplit(':', 2)
+        if host == self.host and pid:
+            return int(pid) == os.getpid() or not process_alive(int(pid))
+        return updated < datetime.now() - timedelta(seconds=self.stale_after)
+
+    def requeue_orphaned(self) -> list[int]:
+        'Switches orphaned running jobs back to "queued", returns their IDs'
+        with DBSession() as session:
+            running = session.execute(
+                select(JobDB.id, JobDB.worker, JobDB.updated).where(JobDB.status == 'running')
+            ).all()
+            ids = []
+            for id, worker, updated in running:
+                if not self.is_orphaned(worker, updated):
+                    continue
+                # the job may have progressed or finished since it was read
+                if session.execute(
+                    update(JobDB)
+                    .where(JobDB.id == id)
+                    .where(JobDB.status == 'running')
+                    .where(JobDB.updated == updated)
+                    .values(status='queued')
+                ).rowcount:
+                    ids.append(id)
+            session.commit()
+        return ids
+
+    def resume(self) -> None:
+        'Schedules jobs interrupted by restarts and starts checks for orphaned jobs'
+        self.requeue_orphaned()
+        with ReadDBSession() as session:
+            ids = session.execute(
+                select(JobDB.id).where(JobDB.status == 'queued').order_by(JobDB.id)
+            ).scalars().all()
+
+        for id in ids:
+            self.executor.submit(self.run, id)
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._sweep, daemon=True)
+                self.thread.start()
+
+    def _sweep(self) -> None:
+        while True:
+            sleep(self.sweep_interval)
+            try:
+                for id in self.requeue_orphaned():
+                    self.executor.submit(self.run, id)
+            except Exception:
+                traceback.print_exc()
+
+    def _finish(self, id: int, **values) -> None:
+        with DBSession() as session:
+            session.execute(
+                update(JobDB)
+                .where(JobDB.id == id)
+                .values(updated=datetime.now(), **values)
+            )
+            session.commit()
+
+    def run(self, id: int) -> None:
+        with DBSession() as session:
+            claimed = session.execute(
+                update(JobDB)
+                .where(JobDB.id == id)
+                .where(JobDB.status == 'queued')
+                .values(status='running', worker=self.worker, updated=datetime.now())
+            ).rowcount
+            session.commit()
+            if not claimed:
+                return  # cancelled or executed by another process
+            job = as_dict(session.get(JobDB, id))
+
+        def progress(stats: dict) -> None:
+            with DBSession() as session:
+                session.execute(
+                    update(JobDB)
+                    .where(JobDB.id == id)
+                    .values(
+                        done=stats['done'],
+                        total=stats['total'],
+                        bytes=stats['bytes'],
+                        errors=stats['errors'],
+                        updated=datetime.now(),
+                    )
+                )
+                session.commit()
+                if session.get(JobDB, id).cancel_requested:
+                    raise JobCancelled()
+
+        try:
+            result = self.runners[job['kind']](job, progress)
+        except JobCancelled:
+            self._finish(id, status='cancelled')
+        except Exception:
+            self._finish(id, status='failed', error=traceback.format_exc())
+        else:
+            self._finish(
+                id,
+                status='done',
+                result=result,
+                done=result['done'],
+                total=result['total'],
+                bytes=result['bytes'],
+                errors=result['errors'],
+            )
+
+
+job_queue = JobQueue(
+    workers=settings.JOBS_WORKERS,
+    stale_after=settings.JOBS_STALE_SECONDS,
+    sweep_interval=settings.JOBS_SWEEP_SECONDS,
+)
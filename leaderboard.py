@@ -0,0 +1,173 @@
+from bisect import insort
+from datetime import datetime
+from threading import Lock
+from time import monotonic
+from db import ReadDBSession, ImageDB, DataVersion, get_image_rows, select_images
+from likes import like_counter
+from settings import settings
+
+
+def query_dashboard(n: int, k: int) -> tuple[list[dict], list[dict]]:
+    'Returns top `n` images by likes and `k` last liked images, pending likes included'
+    pending_ids = like_counter.pending_ids()
+
+    with ReadDBSession() as session:
+        # images with pending likes may enter top and last lists
+        pending = session.execute(
+            select_images()
+            .where(ImageDB.id.in_(pending_ids))
+        ).mappings().all()
+        top = session.execute(
+            select_images()
+            .order_by(ImageDB.likes_count.desc(), ImageDB.id)
+            .limit(n + len(pending_ids))
+        ).mappings().all()
+        last = session.execute(
+            select_images()
+            .order_by(ImageDB.last_update.desc())
+            .where(ImageDB.last_update.isnot(None))
+            .limit(k + len(pending_ids))
+        ).mappings().all()
+
+    top = {image['id']: like_counter.merge(dict(image)) for image in top + pending}
+    last = {image['id']: like_counter.merge(dict(image)) for image in last + pending}
+
+    return (
+        sorted(top.values(), key=top_key)[:n],
+        sorted(
+            (image for image in last.values() if image['last_update'] is not None),
+            key=lambda image: image['last_update'],
+            reverse=True,
+        )[:k],
+    )
+
+
+def top_key(image: dict) -> tuple[int, int]:
+    return -image['likes_count'], image['id']
+
+
+class Leaderboard:
+    '''Dashboard lists kept in memory
+
+    Holds top `size` images by likes (sorted list) and `size` last liked images
+    (most recent first). Both are updated in place on likes, so the dashboard does
+    not touch the database. Likes only grow, so an image outside of the top list can
+    get there only through a like we observe. Rows of liked images outside of the
+    lists are not read on the like request path, but by the next `dashboard` call
+    in one query. Lists are reloaded when the database was changed by other
+    connections, at most once per `refresh_interval`. `generation` changes
+    whenever the lists change
+    '''
+
+    def __init__(self, size: int, refresh_interval: float) -> None:
+        self.size = size
+        self.refresh_interval = refresh_interval
+        self.data_version = DataVersion()
+        self.lock = Lock()
+        self.top: list[tuple[tuple[int, int], dict]] | None = None
+        self.last: list[dict] = []
+        self.generation = 0
+        self.loaded = 0.0
+        self.unseen: set[int] = set()  # liked images outside of the lists
+        # likes (sequence numbers) already included in rows read for unseen images
+        self.read_sequences: dict[int, int] = {}
+
+    def _load(self) -> None:
+        self.unseen.clear()
+        self.read_sequences.clear()
+        top, last = query_dashboard(self.size, self.size)
+        top = [(top_key(image), image) for image in top]
+        if top != self.top or last != self.last:
+            self.top = top
+            self.last = last
+            self.generation += 1
+        self.loaded = monotonic()
+
+    def _refresh(self) -> None:
+        if self.top is None:
+            self.data_version.changed()
+            self._load()
+        elif (
+            monotonic() > self.loaded + self.refresh_interval
+            and self.data_version.changed()
+        ):
+            self._load()
+
+    def _find(self, id: int) -> dict | None:
+        for _, image in self.top:
+            if image['id'] == id:
+                return image
+        for image in self.last:
+            if image['id'] == id:
+                return image
+        return None
+
+    def _put(self, image: dict) -> None:
+        self.top = [item for item in self.top if item[1]['id'] != image['id']]
+        insort(self.top, (top_key(image), image), key=lambda item: item[0])
+        del self.top[self.size:]
+
+        self.last = [item for item in self.last if item['id'] != image['id']]
+        position = 0  # images read later may have been liked before the latest ones
+        while position < len(self.last) and self.last[position]['last_update'] > image['last_update']:
+            position += 1
+        self.last.insert(position, image)
+        del self.last[self.size:]
+
+        self.generation += 1
+
+    def add_likes(self, id: int, delta: int, sequence: int) -> None:
+        with self.lock:
+            if self.top is None:
+                return  # will be loaded from the database
+            if sequence <= self.read_sequences.get(id, 0):
+                return  # already included in the row read for the image
+            if (image := self._find(id)) is not None:
+                self._put({
+                    **image,
+                    'likes_count': image['likes_count'] + delta,
+                    'last_update': datetime.now(),
+                })
+            else:
+                self.unseen.add(id)
+
+    def _read_unseen(self) -> None:
+        'Reads rows of liked images outside of the lists and puts them into the lists'
+        with self.lock:
+            ids, self.unseen = self.unseen, set()
+        if not ids:
+            return
+
+        with like_counter.consistent_read() as (sequence, _):
+            with ReadDBSession() as session:
+                images = get_image_rows(session, sorted(ids))
+            images = [like_counter.merge(image) for image in images]
+
+        with self.lock:
+            for image in images:
+                self.read_sequences[image['id']] = sequence
+                self._put(image)
+
+    def dashboard(self, n: int, k: int) -> tuple[int | None, list[dict], list[dict]]:
+        '''Returns generation, top `n` and last `k` images
+
+        Lists longer than `size` are queried from the database, their generation is None
+        '''
+        if n > self.size or k > self.size:
+            return (None, *query_dashboard(n, k))
+
+        self._read_unseen()
+        with self.lock:
+            self._refresh()
+            return (
+                self.generation,
+                [image for _, image in self.top[:n]],
+                self.last[:k],
+            )
+
+
+leaderboard = Leaderboard(
+    size=settings.LEADERBOARD_SIZE,
+    refresh_interval=settings.LEADERBOARD_REFRESH_SECONDS,
+)
+like_counter.subscribe(leaderboard.add_likes, sequenced=True)
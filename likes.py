@@ -0,0 +1,185 @@
+import atexit
+import traceback
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock, Thread, Event
+from typing import Callable
+from sqlalchemy import update, bindparam
+from db import DBSession, ImageDB
+from settings import settings
+
+
+class LikeCounter:
+    '''Write-behind likes counter
+
+    Likes are accumulated in memory and flushed as a single batch of
+    `likes_count = likes_count + delta` updates every `flush_interval` seconds
+    or every `flush_every` likes, so a crash loses at most one flush interval.
+    Pending likes are visible to readers through `pending` and `merge`
+    '''
+
+    def __init__(self, flush_interval: float, flush_every: int) -> None:
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self.deltas: dict[int, int] = {}
+        self.deltas_total = 0
+        self.last_updates: dict[int, datetime] = {}
+        # likes being written by the current flush, still pending for readers
+        self.flushing_deltas: dict[int, int] = {}
+        self.flushing_last_updates: dict[int, datetime] = {}
+        self.listeners: list[tuple[Callable[..., None], bool]] = []
+        self.flush_listeners: list[Callable[[list[int]], None]] = []
+        self.sequence = 0  # number of likes made by the process
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.flush_requested = Event()
+        self.thread: Thread | None = None
+        atexit.register(self.flush)
+
+    def subscribe(self, listener: Callable[..., None], sequenced: bool = False) -> None:
+        '''Calls `listener(id, delta)` on every like (`listener(id, delta, sequence)`
+        if `sequenced`, see `consistent_read`)
+
+        Listeners are called after the like is recorded, outside of the lock
+        '''
+        self.listeners.append((listener, sequenced))
+
+    def subscribe_flush(self, listener: Callable[[list[int]], None]) -> None:
+        '''Calls `listener(ids)` with IDs of flushed images after the flush committed
+        and its likes stopped being pending
+
+        A row read before the commit and merged with pending likes after it misses
+        the flushed likes, readers that keep rows use this to drop them
+        '''
+        self.flush_listeners.append(listener)
+
+    @contextmanager
+    def consistent_read(self):
+        '''Yields `(sequence, pending deltas)` and holds flushes until the block exits
+
+        Rows read inside the block with pending deltas applied include exactly the
+        likes of this process with sequence numbers up to `sequence`
+        '''
+        with self.flush_lock:
+            with self.lock:
+                pending = dict(self.flushing_deltas)
+                for id, delta in self.deltas.items():
+                    pending[id] = pending.get(id, 0) + delta
+                sequence = self.sequence
+            yield sequence, pending
+
+    def _start(self) -> None:
+        if self.thread is None:
+            self.thread = Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def like(self, id: int, delta: int = 1) -> None:
+        with self.lock:
+            self._start()
+            self.deltas[id] = self.deltas.get(id, 0) + delta
+            self.deltas_total += delta
+            self.last_updates[id] = datetime.now()
+            self.sequence += 1
+            sequence = self.sequence
+            if self.deltas_total >= self.flush_every:
+                self.flush_requested.set()
+
+        for listener, sequenced in self.listeners:
+            if sequenced:
+                listener(id, delta, sequence)
+            else:
+                listener(id, delta)
+
+    def pending(self, id: int) -> int:
+        'Returns number of likes of the image not yet written to the database'
+        with self.lock:
+            return self.deltas.get(id, 0) + self.flushing_deltas.get(id, 0)
+
+    def pending_ids(self) -> set[int]:
+        with self.lock:
+            return self.deltas.keys() | self.flushing_deltas.keys()
+
+    def merge(self, image: dict) -> dict:
+        'Returns `images` row with pending likes applied'
+        with self.lock:
+            delta = (
+                self.deltas.get(image['id'], 0)
+                + self.flushing_deltas.get(image['id'], 0)
+            )
+            last_update = (
+                self.last_updates.get(image['id'])
+                or self.flushing_last_updates.get(image['id'])
+            )
+
+        if delta == 0:
+            return image
+        return {
+            **image,
+            'likes_count': (image['likes_count'] or 0) + delta,
+            'last_update': last_update,
+        }
+
+    def flush(self) -> int:
+        'Writes pending likes in one transaction, returns number of flushed likes'
+        with self.flush_lock:
+            with self.lock:
+                if not self.deltas:
+                    return 0
+                self.flushing_deltas, self.deltas = self.deltas, {}
+                self.deltas_total = 0
+                self.flushing_last_updates, self.last_updates = self.last_updates, {}
+
+            try:
+                with DBSession() as session:
+                    images = ImageDB.__table__
+                    session.execute(
+                        update(images)
+                        .where(images.c.id == bindparam('b_id'))
+                        .values(
+                            likes_count=images.c.likes_count + bindparam('b_delta'),
+                            last_update=bindparam('b_last_update'),
+                        ),
+                        [
+                            {
+                                'b_id': id,
+                                'b_delta': delta,
+                                'b_last_update': self.flushing_last_updates[id],
+                            }
+                            for id, delta in self.flushing_deltas.items()
+                        ],
+                    )
+                    session.commit()
+            except Exception:
+                with self.lock:  # keep likes for the next flush
+                    for id, delta in self.flushing_deltas.items():
+                        self.deltas[id] = self.deltas.get(id, 0) + delta
+                        self.deltas_total += delta
+                        self.last_updates.setdefault(id, self.flushing_last_updates[id])
+                    self.flushing_deltas = {}
+                    self.flushing_last_updates = {}
+                raise
+
+            with self.lock:
+                flushed_ids = list(self.flushing_deltas)
+                flushed = sum(self.flushing_deltas.values())
+                self.flushing_deltas = {}
+                self.flushing_last_updates = {}
+
+            for listener in self.flush_listeners:
+                listener(flushed_ids)
+            return flushed
+
+
+like_counter = LikeCounter(
+    flush_interval=settings.LIKES_FLUSH_INTERVAL,
+    flush_every=settings.LIKES_FLUSH_EVERY,
+)
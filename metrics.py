@@ -0,0 +1,234 @@
+import os
+import re
+import sys
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from time import perf_counter, monotonic, sleep
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    CONTENT_TYPE_LATEST,
+)
+from prometheus_client.multiprocess import MultiProcessCollector
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.requests import Request
+from settings import settings
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+http_request_duration = Histogram(
+    'http_request_duration_seconds',
+    'HTTP requests latency (until response headers for streaming responses)',
+    ['method', 'path', 'status'],
+    buckets=LATENCY_BUCKETS,
+)
+db_query_duration = Histogram(
+    'db_query_duration_seconds',
+    'Database statements latency by normalized SQL',
+    ['engine', 'statement'],
+    buckets=LATENCY_BUCKETS,
+)
+vk_api_duration = Histogram(
+    'vk_api_duration_seconds',
+    'VK API calls latency (including waiting for the rate limiter)',
+    ['method', 'outcome'],
+    buckets=LATENCY_BUCKETS,
+)
+vk_api_retries = Counter(
+    'vk_api_retries',
+    'Retried VK API calls by the error',
+    ['method', 'reason'],
+)
+image_download_duration = Histogram(
+    'image_download_duration_seconds',
+    'Image files downloads latency',
+    ['outcome'],
+    buckets=LATENCY_BUCKETS,
+)
+image_download_bytes = Counter(
+    'image_download_bytes',
+    'Downloaded image files bytes',
+)
+cache_lookups = Counter(
+    'cache_lookups',
+    'Cache lookups (see image_cache.py, open file handles, sample prefetch buffers)',
+    ['cache', 'result'],
+)
+
+
+def metrics_response() -> tuple[bytes, str]:
+    '''Returns metrics in Prometheus text format and its content type
+
+    With several uvicorn workers set PROMETHEUS_MULTIPROC_DIR to an empty directory,
+    so metrics of all workers are collected
+    '''
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+@lru_cache(maxsize=1024)
+def normalize_sql(statement: str) -> str:
+    'Collapses literals, parameter lists and whitespace, so statements differing in values match'
+    statement = re.sub(r"'(?:[^']|'')*'", '?', statement)
+    statement = re.sub(r'\b\d+(?:\.\d+)?\b', '?', statement)
+    statement = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', statement)
+    statement = re.sub(r'\(\s*\(\?\)(?:\s*,\s*\(\?\))*\s*\)', '((?))', statement)
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return statement[:300]
+
+
+def instrument_engine(engine: Engine, name: str) -> None:
+    'Times every statement executed by the engine'
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['query_start'].pop()
+        db_query_duration.labels(name, normalize_sql(statement)).observe(perf_counter() - start)
+
+
+@contextmanager
+def timed_vk_call(method: str):
+    'Times a VK API method call (including retries and waiting for the rate limiter)'
+    start = perf_counter()
+    try:
+        yield
+    except BaseException:
+        vk_api_duration.labels(method, 'error').observe(perf_counter() - start)
+        raise
+    vk_api_duration.labels(method, 'ok').observe(perf_counter() - start)
+
+
+@contextmanager
+def timed_download():
+    'Times image download, yielded list gets number of downloaded bytes'
+    start = perf_counter()
+    size = []
+    try:
+        yield size
+    except BaseException:
+        image_download_duration.labels('error').observe(perf_counter() - start)
+        raise
+    image_download_duration.labels('ok').observe(perf_counter() - start)
+    image_download_bytes.inc(sum(size))
+
+
+IDLE_FILES = ('threading.py', 'selectors.py', 'queue.py', 'thread.py')
+
+
+class SlowRequestProfiler:
+    '''Opt-in sampling profiler for slow requests
+
+    While requests are in flight all threads are sampled every `interval` seconds.
+    When a request takes more than `slow_ms`, samples taken during it are written
+    to `path` in folded stacks format (flamegraph.pl, speedscope). Samples are not
+    attributed to requests, so concurrent requests show up in each other profiles.
+    Idle threads (waiting on locks, queues, sockets) are skipped
+    '''
+
+    def __init__(self, slow_ms: int, interval: float, path: str) -> None:
+        self.slow_ms = slow_ms
+        self.interval = interval
+        self.path = Path(path)
+        self.samples: deque[tuple[float, str]] = deque(maxlen=100_000)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+        self.thread: threading.Thread | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.slow_ms > 0
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while True:
+            self.active.wait()
+            now = monotonic()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or frame.f_code.co_filename.endswith(IDLE_FILES):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f'{Path(frame.f_code.co_filename).stem}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+                self.samples.append((now, ';'.join(reversed(stack))))
+            sleep(self.interval)
+
+    def start_request(self) -> float:
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.in_flight += 1
+            self.active.set()
+        return monotonic()
+
+    def finish_request(self, start: float, name: str) -> Path | None:
+        'Dumps samples of the request if it was slow, returns the file path'
+        end = monotonic()
+        with self.lock:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self.active.clear()
+
+        if (end - start) * 1000 < self.slow_ms:
+            return None
+
+        counts: dict[str, int] = {}
+        for time, stack in list(self.samples):
+            if start <= time <= end:
+                counts[stack] = counts.get(stack, 0) + 1
+        if not counts:
+            return None
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        name = re.sub(r'\W+', '_', name).strip('_')
+        path = self.path / f'{datetime.now():%Y%m%d-%H%M%S-%f}-{name}-{(end - start) * 1000:.0f}ms.folded'
+        path.write_text(''.join(f'{stack} {count}\n' for stack, count in counts.items()))
+        return path
+
+
+profiler = SlowRequestProfiler(
+    slow_ms=settings.PROFILE_SLOW_REQUESTS_MS,
+    interval=settings.PROFILE_INTERVAL,
+    path=settings.PROFILE_PATH,
+)
+
+
+async def metrics_middleware(request: Request, call_next):
+    'Times requests by route template and profiles slow ones'
+    profiling = profiler.enabled
+    if profiling:
+        profile_start = profiler.start_request()
+    start = perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        if (route := request.scope.get('route')) is not None:
+            path = route.path  # template, e.g. /api/jobs/{id}
+        elif 'endpoint' in request.scope:
+            path = request.url.path  # docs
+        else:
+            path = 'unmatched'
+        http_request_duration.labels(request.method, path, status).observe(perf_counter() - start)
+        if profiling:
+            profiler.finish_request(profile_start, f'{request.method} {path}')
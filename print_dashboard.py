@@ -1,43 +1,112 @@
-from typing import Any
+import json
+from typing import Any, Protocol
 from datetime import datetime, timedelta
+from threading import Thread, Lock
+from time import sleep
 import click
+import requests
 import pytermgui as ptg
 from settings import settings
-from db import DBSession, ImageDB
+from leaderboard import leaderboard
+
+
+class DashboardSource(Protocol):
+    def dashboard(self, n: int, k: int) -> tuple[int | None, list[dict], list[dict]]:
+        ...
+
+
+class DashboardStreamClient:
+    'Dashboard data source reading `/api/dashboard_stream` of a running API'
+
+    def __init__(self, url: str, n: int, k: int, secret: str) -> None:
+        self.url = f'{url.rstrip("/")}/api/dashboard_stream'
+        self.params = {'n': n, 'k': k}
+        self.headers = {'X-Dashboard-Secret': secret}
+        self.lock = Lock()
+        self.generation = 0
+        self.top: list[dict] = []
+        self.last: list[dict] = []
+
+    def connect(self) -> requests.Response:
+        res = requests.get(
+            self.url,
+            params=self.params,
+            headers=self.headers,
+            stream=True,
+        )
+        if res.status_code != 200:
+            raise Exception(f'{res}: {res.text}')
+        return res
+
+    def start(self) -> None:
+        'Connects to the stream (raises on errors) and reads it in a background thread'
+        res = self.connect()
+        Thread(target=self.run, args=(res,), daemon=True).start()
+
+    def run(self, res: requests.Response) -> None:
+        while True:
+            try:
+                for line in res.iter_lines(decode_unicode=True):
+                    if line.startswith('data: '):
+                        self.apply(json.loads(line[len('data: '):]))
+            except requests.RequestException:
+                pass
+            while True:  # reconnect
+                sleep(1)
+                try:
+                    res = self.connect()
+                    break
+                except Exception:
+                    pass
+
+    def apply(self, changes: dict) -> None:
+        for images in changes.values():
+            for image in images:
+                if image['last_update'] is not None:
+                    image['last_update'] = datetime.fromisoformat(image['last_update'])
+
+        with self.lock:
+            self.top = changes.get('top', self.top)
+            self.last = changes.get('last', self.last)
+            self.generation += 1
+
+    def dashboard(self, n: int, k: int) -> tuple[int | None, list[dict], list[dict]]:
+        with self.lock:
+            return self.generation, self.top[:n], self.last[:k]
 
 
 class TopTableWidget(ptg.Widget):
 
-    def __init__(self, n: int, framerate: int, **attrs: Any) -> None:
+    def __init__(
+        self,
+        n: int,
+        framerate: int,
+        source: DashboardSource = leaderboard,
+        **attrs: Any
+    ) -> None:
         super().__init__(**attrs)
         self.n = n
         self.framerate = framerate
+        self.source = source
         self.last_update = datetime.now()
         self.table_lines = self.query_lines()
 
     def query_lines(self) -> list[str]:
-        with DBSession() as session:
-            images: list[ImageDB] = (
-                session
-                .query(ImageDB)
-                .order_by(ImageDB.likes_count.desc())
-                .limit(self.n)
-                .all()
-            )
-
-            return [
-                f'Время обновления: {datetime.now()}',
-                '',
-                f'{"ID":^4}|{"Автор":^25}|Лайки|{"Путь":^35}',
-                f'{"-"*4}+{"-"*25}+{"-"*5}+{"-"*35}',
-            ] + [
-                f'''{
-                    image.id:>4}|{
-                    image.author_name[:25]:>25}|{
-                    min(image.likes_count, 99999):>5}|{
-                    image.path[:35]:>35}'''
-                for image in images
-            ]
+        _, images, _ = self.source.dashboard(n=self.n, k=0)
+
+        return [
+            f'Время обновления: {datetime.now()}',
+            '',
+            f'{"ID":^4}|{"Автор":^25}|Лайки|{"Путь":^35}',
+            f'{"-"*4}+{"-"*25}+{"-"*5}+{"-"*35}',
+        ] + [
+            f'''{
+                image["id"]:>4}|{
+                image["author_name"][:25]:>25}|{
+                min(image["likes_count"], 99999):>5}|{
+                image["path"][:35]:>35}'''
+            for image in images
+        ]
 
     def get_lines(self) -> list[str]:
         if datetime.now() > self.last_update + timedelta(seconds=1/self.framerate):
@@ -49,39 +118,38 @@ class TopTableWidget(ptg.Widget):
 
 class LastTableWidget(ptg.Widget):
 
-    def __init__(self, n: int, framerate: int, **attrs: Any) -> None:
+    def __init__(
+        self,
+        n: int,
+        framerate: int,
+        source: DashboardSource = leaderboard,
+        **attrs: Any
+    ) -> None:
         super().__init__(**attrs)
         self.n = n
         self.framerate = framerate
+        self.source = source
         self.last_update = datetime.now()
         self.table_lines = self.query_lines()
 
     def query_lines(self) -> list[str]:
-        with DBSession() as session:
-            images: list[ImageDB] = (
-                session
-                .query(ImageDB)
-                .order_by(ImageDB.last_update.desc())
-                .where(ImageDB.last_update.isnot(None))
-                .limit(self.n)
-                .all()
-            )
-
-            return [
-                f'{"Прошло времени":^20}|{"ID":^4}|{"Автор":^25}|Лайки|{"Путь":^35}',
-                f'{"-"*20}+{"-"*4}+{"-"*25}+{"-"*5}+{"-"*35}',
-            ] + [
-                f'''{
-                    str(datetime.now() - image.last_update)[:20]:>20}|{
-                    image.id:>4}|{
-                    image.author_name[:25]:>25}|{
-                    min(image.likes_count, 99999):>5}|{
-                    image.path[:35]:>35}'''
-                for image in images
-            ] + [
-                f'{" "*20}+{" "*4}+{" "*25}+{" "*5}+{" "*35}'
-                for _ in range(self.n - len(images))
-            ]
+        _, _, images = self.source.dashboard(n=0, k=self.n)
+
+        return [
+            f'{"Прошло времени":^20}|{"ID":^4}|{"Автор":^25}|Лайки|{"Путь":^35}',
+            f'{"-"*20}+{"-"*4}+{"-"*25}+{"-"*5}+{"-"*35}',
+        ] + [
+            f'''{
+                str(datetime.now() - image["last_update"])[:20]:>20}|{
+                image["id"]:>4}|{
+                image["author_name"][:25]:>25}|{
+                min(image["likes_count"], 99999):>5}|{
+                image["path"][:35]:>35}'''
+            for image in images
+        ] + [
+            f'{" "*20}+{" "*4}+{" "*25}+{" "*5}+{" "*35}'
+            for _ in range(self.n - len(images))
+        ]
 
     def get_lines(self) -> list[str]:
         if datetime.now() > self.last_update + timedelta(seconds=1/self.framerate):
@@ -95,22 +163,35 @@ class LastTableWidget(ptg.Widget):
 @click.option('-n', default=5, show_default=True, help='Количество изображений в топе')
 @click.option('-k', default=5, show_default=True, help='Количество изображений в последних')
 @click.option('--secret', type=str, required=True, help='Секрет для доступа к топу')
-def main(n: int, k: int, secret: str):
+@click.option('--url', type=str, default=None, help='Адрес API, изменения дашборда которого нужно получать (например, http://localhost:4000)')
+def main(n: int, k: int, secret: str, url: str | None):
     """Script prints images dashboard"""
 
-    if secret != settings.SECRET:  # Yes, yes, not safe
-        click.echo('Invalid secret!', err=True)
-        exit(1)
+    if url is not None:
+        source = DashboardStreamClient(url=url, n=n, k=k, secret=secret)
+        try:
+            source.start()
+        except Exception as ex:
+            click.echo(f'Не удалось подключиться к API: {ex}', err=True)
+            exit(1)
+    else:
+        if secret != settings.SECRET:  # Yes, yes, not safe
+            click.echo('Invalid secret!', err=True)
+            exit(1)
+
+        # the dashboard only queries the database when it was changed
+        leaderboard.refresh_interval = 0
+        source = leaderboard
 
     with ptg.WindowManager() as manager:
         window = ptg.Window(
             f'[210 bold]TОП {n} изображений',
             '',
-            TopTableWidget(n=n, framerate=1),
+            TopTableWidget(n=n, framerate=1, source=source),
             '',
             f'[210 bold]Последние {k} лайкнутых изображений',
             '',
-            LastTableWidget(n=k, framerate=1),
+            LastTableWidget(n=k, framerate=1, source=source),
             width=105,
             height=n+k+10,
         )
@@ -1,21 +1,62 @@
 import click
-from db import DBSession, ImageDB
+from sqlalchemy import func
+from sqlalchemy.sql import Select
+from db import ReadDBSession, ImageDB, select_images
+from settings import settings
+
+
+def images_query(
+    after: int = 0,
+    album_id: int | None = None,
+    author_id: int | None = None,
+) -> Select:
+    'Images with ID greater than `after` (keyset pagination) ordered by ID'
+    query = select_images().where(ImageDB.id > after).order_by(ImageDB.id)
+    if album_id is not None:
+        query = query.where(ImageDB.album_id == album_id)
+    if author_id is not None:
+        query = query.where(ImageDB.author_id == author_id)
+    return query
+
+
+def iter_images(
+    after: int = 0,
+    album_id: int | None = None,
+    author_id: int | None = None,
+    limit: int | None = None,
+):
+    'Yields images as they are fetched from the database, memory usage is constant'
+    query = images_query(after=after, album_id=album_id, author_id=author_id)
+    if limit is not None:
+        query = query.limit(limit)
+
+    with ReadDBSession() as session:
+        for image in session.execute(
+            query.execution_options(yield_per=settings.IMAGES_YIELD_PER)
+        ).mappings():
+            yield dict(image)
 
 
 @click.command()
-def main():
+@click.option("--album-id", type=int, default=None, help="ID альбома")
+@click.option("--author-id", type=int, default=None, help="ID автора")
+def main(album_id: int | None, author_id: int | None):
     """Script prints all images from database"""
 
-    with DBSession() as session:
-        images: list[ImageDB] = session.query(ImageDB).all()
-        count = len(images)
-        count_signs = len(str(count))
-        for i, image in enumerate(images, start=1):
-            click.echo(
-                f'({i:{count_signs}}/{count:{count_signs}}) '
-                f'{image.author_name} (https://vk.com/id{image.author_id}) '
-                f'получил {image.likes_count} лайк(-ов) за мем {image.url}'
-            )
+    with ReadDBSession() as session:
+        count = session.execute(
+            images_query(album_id=album_id, author_id=author_id)
+            .with_only_columns(func.count())
+            .order_by(None)
+        ).scalar()
+
+    count_signs = len(str(count))
+    for i, image in enumerate(iter_images(album_id=album_id, author_id=author_id), start=1):
+        click.echo(
+            f'({i:{count_signs}}/{count:{count_signs}}) '
+            f'{image["author_name"]} (https://vk.com/id{image["author_id"]}) '
+            f'получил {image["likes_count"]} лайк(-ов) за мем {image["url"]}'
+        )
 
 
 if __name__ == '__main__':
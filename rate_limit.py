@@ -0,0 +1,32 @@
+from threading import Lock
+from time import monotonic, sleep
+
+
+class TokenBucket:
+    'Thread-safe token bucket: `rate` tokens per second with bursts up to `capacity`'
+
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def acquire(self, tokens: float = 1) -> None:
+        'Blocks until `tokens` tokens are available and takes them'
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            sleep(wait)
@@ -0,0 +1,159 @@
+import click
+from typing import Callable
+from sqlalchemy import select, update, bindparam, func
+from db import DBSession, ReadDBSession, ImageDB, AlbumCheckpointDB, init_db
+from vk_api import get_images_by_ids
+from authors import author_resolver
+from image_cache import image_cache
+from settings import settings
+
+
+def album_owner_id(album_id: int) -> int | None:
+    'Returns owner of an ingested album from its sync checkpoint'
+    with ReadDBSession() as session:
+        return session.execute(
+            select(AlbumCheckpointDB.owner_id).where(AlbumCheckpointDB.album_id == album_id)
+        ).scalar()
+
+
+def save_refreshed_page(rows: list[dict]) -> None:
+    '''Applies current VK likes and author names to a page of images in one transaction
+
+    VK likes change `likes_count` by the difference with the previous sync, so
+    likes made here are kept. Rows synced before `vk_likes_count` existed get
+    only the baseline (their VK likes and likes made here are not distinguishable)
+    '''
+    images = ImageDB.__table__
+    with DBSession() as session:
+        session.execute(
+            update(images)
+            .where(images.c.id == bindparam('b_id'))
+            .values(
+                likes_count=(
+                    func.coalesce(images.c.likes_count, 0)
+                    + bindparam('b_vk_likes_count')
+                    - func.coalesce(images.c.vk_likes_count, bindparam('b_vk_likes_count'))
+                ),
+                vk_likes_count=bindparam('b_vk_likes_count'),
+                author_name=bindparam('b_author_name'),
+            ),
+            rows,
+        )
+        session.commit()
+
+
+def refresh_images(
+    album_id: int,
+    owner_id: int | None = None,
+    print_info: bool = False,
+    progress: Callable[[dict], None] | None = None,
+) -> dict:
+    '''Updates VK likes and author names of already ingested images of the album
+
+    Images are walked by ID in pages of `REFRESH_PAGE_SIZE`, every page takes one
+    `execute` with `photos.getById` calls (`REFRESH_BATCH_SIZE` photos each), fresh
+    `users.get` calls and one batched UPDATE. Image files are not touched.
+    `owner_id` defaults to the one the album was downloaded with. Returns numbers
+    of updated images, images `missing` in VK (deleted), changed likes and names
+    '''
+    init_db()
+    if owner_id is None and (owner_id := album_owner_id(album_id)) is None:
+        raise click.ClickException(
+            'Не удалось определить владельца альбома, укажите его ID'
+        )
+
+    with ReadDBSession() as session:
+        total = session.execute(
+            select(func.count()).select_from(ImageDB).where(ImageDB.album_id == album_id)
+        ).scalar()
+
+    stats = {
+        'updated': 0, 'missing': 0, 'likes': 0, 'authors': 0,
+        'done': 0, 'total': total, 'bytes': 0, 'errors': 0,
+    }
+    after = 0
+
+    while True:
+        with ReadDBSession() as session:
+            page = session.execute(
+                select(
+                    ImageDB.id,
+                    ImageDB.image_id,
+                    ImageDB.author_id,
+                    ImageDB.author_name,
+                    ImageDB.vk_likes_count,
+                )
+                .where(ImageDB.album_id == album_id)
+                .where(ImageDB.id > after)
+                .order_by(ImageDB.id)
+                .limit(settings.REFRESH_PAGE_SIZE)
+            ).mappings().all()
+        if not page:
+            break
+        after = page[-1]['id']
+
+        photos = {
+            photo['id']: photo
+            for photo in get_images_by_ids(
+                owner_id=owner_id,
+                images_ids=[image['image_id'] for image in page],
+                batch_size=settings.REFRESH_BATCH_SIZE,
+            )
+        }
+        users_names = author_resolver.resolve(
+            {image['author_id'] for image in page if image['image_id'] in photos},
+            fresh=True,
+        )
+
+        rows = []
+        for image in page:
+            if (photo := photos.get(image['image_id'])) is None:
+                stats['missing'] += 1
+                continue
+            vk_likes_count = photo['likes']['count']
+            author_name = users_names.get(image['author_id'], image['author_name'])
+            if image['vk_likes_count'] is not None:
+                stats['likes'] += vk_likes_count - image['vk_likes_count']
+            stats['authors'] += author_name != image['author_name']
+            rows.append({
+                'b_id': image['id'],
+                'b_vk_likes_count': vk_likes_count,
+                'b_author_name': author_name,
+            })
+
+        if rows:
+            save_refreshed_page(rows)
+            image_cache.invalidate_images([row['b_id'] for row in rows])
+        stats['updated'] += len(rows)
+        stats['done'] += len(page)
+
+        if print_info:
+            click.echo(
+                f'({stats["done"]}/{stats["total"]}) обновлено изображений: {stats["updated"]}, '
+                f'нет в VK: {stats["missing"]}'
+            )
+        if progress is not None:
+            progress(stats)
+
+    if print_info:
+        click.echo(
+            f'Обновлено изображений: {stats["updated"]}, '
+            f'изменение лайков VK: {stats["likes"]:+}, '
+            f'изменено имен авторов: {stats["authors"]}'
+            + (f', удалено из VK: {stats["missing"]}' if stats['missing'] else '')
+        )
+
+    return stats
+
+
+@click.command()
+@click.option("--album-id", default=281940823, show_default=True, help="ID альбома")
+@click.option("--owner-id", type=int, default=None, help="ID владельца альбома (по умолчанию тот, с которым альбом загружался)")
+@click.option("--no-print-info", default=False, is_flag=True, help="Скрыть доп. информацию с консоли")
+def main(album_id: int, owner_id: int | None, no_print_info: bool):
+    """Script that updates VK likes and authors names of downloaded images"""
+    refresh_images(album_id=album_id, owner_id=owner_id, print_info=not no_print_info)
+
+
+if __name__ == '__main__':
+    main()
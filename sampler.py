@@ -0,0 +1,258 @@
+import random
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic
+from typing import Container
+from sqlalchemy import select
+from db import ReadDBSession, ImageDB, DataVersion
+from likes import like_counter
+from metrics import cache_lookups
+from settings import settings
+
+
+class FenwickTree:
+    'Prefix sums over non-negative integer weights with O(log n) updates and search'
+
+    def __init__(self, weights: list[int]) -> None:
+        self.size = len(weights)
+        self.tree = [0] + list(weights)
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(weights)
+
+    def add(self, index: int, delta: int) -> None:
+        self.total += delta
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, value: int) -> int:
+        'Returns the first index whose prefix sum is greater than `value`'
+        index = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            next_index = index + step
+            if next_index <= self.size and self.tree[next_index] <= value:
+                index = next_index
+                value -= self.tree[next_index]
+            step >>= 1
+        return index
+
+
+class WeightedSampler:
+    '''In-memory image weights for `explore_images_v2.next_image`
+
+    Every image has weight `likes_count + 1`, the favourite one has weight equal
+    to the sum of weights of the other candidates, exactly as in the former SQL
+    query. Sampling and likes cost O(log n); weights are (re)loaded lazily when
+    the database was changed by other connections, at most once per
+    `SAMPLER_REFRESH_SECONDS`
+    '''
+
+    def __init__(self, refresh_interval: float) -> None:
+        self.refresh_interval = refresh_interval
+        self.data_version = DataVersion()
+        self.lock = Lock()
+        self.ids: list[int] = []
+        self.weights: list[int] = []
+        self.tree: FenwickTree | None = None
+        self.loaded = 0.0
+        self.sequence = 0  # likes of this process included in the loaded weights
+
+    def _load(self) -> None:
+        # pending likes are applied and likes up to `sequence` are not added again
+        with like_counter.consistent_read() as (sequence, pending):
+            with ReadDBSession() as session:
+                rows = session.execute(
+                    select(ImageDB.id, ImageDB.likes_count).order_by(ImageDB.id)
+                ).all()
+
+        self.ids = [id for id, _ in rows]
+        self.weights = [(likes_count or 0) + pending.get(id, 0) + 1 for id, likes_count in rows]
+        self.tree = FenwickTree(self.weights)
+        self.loaded = monotonic()
+        self.sequence = sequence
+
+    def _refresh(self) -> None:
+        if self.tree is None:
+            self.data_version.changed()
+            self._load()
+        elif (
+            monotonic() > self.loaded + self.refresh_interval
+            and self.data_version.changed()
+        ):
+            self._load()
+
+    def _index(self, id: int) -> int | None:
+        i = bisect_left(self.ids, id)
+        return i if i < len(self.ids) and self.ids[i] == id else None
+
+    def add_likes(self, id: int, delta: int, sequence: int) -> None:
+        with self.lock:
+            if self.tree is None or sequence <= self.sequence:
+                return  # will be loaded or already loaded from the database
+            if (i := self._index(id)) is not None:
+                self.weights[i] += delta
+                self.tree.add(i, delta)
+
+    def _draw(
+        self,
+        favourite: int | None,
+        previous: int | None,
+        exclude: Container[int] | None,
+        drawn: set[int],
+        attempts: int,
+    ) -> int | None:
+        tree = self.tree
+        changes = []
+
+        if previous is not None:
+            changes.append((previous, -self.weights[previous]))
+            tree.add(previous, -self.weights[previous])
+
+        if favourite is not None and favourite != previous:
+            # favourite weight is the sum of weights of the other candidates
+            delta = tree.total - 2 * self.weights[favourite]
+            changes.append((favourite, delta))
+            tree.add(favourite, delta)
+
+        try:
+            if tree.total <= 0:
+                return None
+            for _ in range(attempts):
+                sampled = self.ids[tree.find(random.randrange(tree.total))]
+                if exclude is None or (sampled not in exclude and sampled not in drawn):
+                    return sampled
+            return None
+        finally:
+            for index, delta in changes:
+                tree.add(index, -delta)
+
+    def sample_many(
+        self,
+        favourite_id: int,
+        id: int = -1,
+        count: int = 1,
+        exclude: Container[int] | None = None,
+        attempts: int = 1,
+    ) -> list[int]:
+        '''Returns up to `count` random image IDs, the first other than `id`, each
+        next other than the previous one
+
+        Weights are refreshed and locked once for the batch. Draws of images in
+        `exclude` are rejected and repeated, so excluded images are not scanned.
+        With `exclude` IDs drawn earlier in the batch (except the favourite) are
+        excluded too, and the batch is cut short when all `attempts` draws of an
+        ID were rejected
+        '''
+        with self.lock:
+            self._refresh()
+            favourite = self._index(favourite_id)
+            sampled_ids = []
+            drawn = set()
+            previous = self._index(id)
+            for _ in range(count):
+                sampled = self._draw(favourite, previous, exclude, drawn, attempts)
+                if sampled is None:
+                    break
+                sampled_ids.append(sampled)
+                if sampled != favourite_id:
+                    drawn.add(sampled)
+                previous = self._index(sampled)
+            return sampled_ids
+
+
+class SamplePrefetcher:
+    '''Buffers of pre-sampled image IDs by favourite for swipes without a session
+
+    A swipe takes the next IDs from memory, a background thread refills a buffer
+    once it is half empty. Buffered draws may miss likes made after they were
+    sampled (at most `size` draws), buffers are dropped when weights are reloaded
+    from the database. Buffers of at most `max_favourites` recently used
+    favourites are kept
+    '''
+
+    def __init__(self, sampler: WeightedSampler, size: int, max_favourites: int) -> None:
+        self.sampler = sampler
+        self.size = size
+        self.max_favourites = max_favourites
+        self.buffers: OrderedDict[int, deque[int]] = OrderedDict()
+        self.refilling: set[int] = set()
+        self.loaded = 0.0
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+
+    def _drop_stale(self) -> bool:
+        'Drops buffers sampled before weights were reloaded'
+        if self.loaded == self.sampler.loaded:
+            return False
+        self.buffers.clear()
+        self.loaded = self.sampler.loaded
+        return True
+
+    def _refill(self, favourite_id: int) -> None:
+        try:
+            with self.lock:
+                buffer = self.buffers.get(favourite_id)
+                if buffer is None:
+                    return
+                previous = buffer[-1] if buffer else -1
+                missing = self.size - len(buffer)
+
+            sampled = self.sampler.sample_many(favourite_id, previous, missing)
+
+            with self.lock:
+                if self._drop_stale():
+                    self.buffers[favourite_id] = deque()
+                if (buffer := self.buffers.get(favourite_id)) is not None:
+                    buffer.extend(sampled)
+        finally:
+            with self.lock:
+                self.refilling.discard(favourite_id)
+
+    def take(self, favourite_id: int, id: int = -1, count: int = 1) -> list[int]:
+        'Returns up to `count` random image IDs like `WeightedSampler.sample_many`'
+        if self.size <= 0:
+            return self.sampler.sample_many(favourite_id, id, count)
+
+        sampled = []
+        previous = id
+        with self.lock:
+            self._drop_stale()
+            if (buffer := self.buffers.get(favourite_id)) is None:
+                buffer = self.buffers[favourite_id] = deque()
+                while len(self.buffers) > self.max_favourites:
+                    self.buffers.popitem(last=False)
+            else:
+                self.buffers.move_to_end(favourite_id)
+
+            while buffer and len(sampled) < count:
+                next_id = buffer.popleft()
+                if next_id != previous:
+                    sampled.append(next_id)
+                    previous = next_id
+
+            refill = len(buffer) <= self.size // 2 and favourite_id not in self.refilling
+            if refill:
+                self.refilling.add(favourite_id)
+
+        cache_lookups.labels('sample_prefetch', 'hit' if len(sampled) == count else 'miss').inc()
+        if len(sampled) < count:
+            sampled += self.sampler.sample_many(favourite_id, previous, count - len(sampled))
+        if refill:
+            self.executor.submit(self._refill, favourite_id)
+        return sampled
+
+
+weighted_sampler = WeightedSampler(refresh_interval=settings.SAMPLER_REFRESH_SECONDS)
+like_counter.subscribe(weighted_sampler.add_likes, sequenced=True)
+sample_prefetcher = SamplePrefetcher(
+    weighted_sampler,
+    size=settings.EXPLORE_PREFETCH_SIZE,
+    max_favourites=settings.EXPLORE_PREFETCH_FAVOURITES,
+)
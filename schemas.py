@@ -0,0 +1,22 @@
+from datetime import datetime
+from pydantic import BaseModel
+
+
+class Image(BaseModel):
+    'Row of the `images` table as returned by the API (keys in order of `db.IMAGE_COLUMNS`)'
+    author_id: int | None
+    album_position: int | None
+    likes_count: int | None
+    path: str | None
+    id: int
+    image_id: int
+    album_id: int
+    author_name: str | None
+    url: str | None
+    last_update: datetime | None
+    vk_likes_count: int | None
+
+
+class Dashboard(BaseModel):
+    top: list[Image]
+    last: list[Image]
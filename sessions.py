@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from uuid import uuid4
+from settings import settings
+
+MASK_64 = (1 << 64) - 1
+
+
+class SeenFilter:
+    '''Bloom filter of seen image IDs with fixed memory (`bits` / 8 bytes)
+
+    May report an unseen image as seen (about 1% when `capacity` IDs were added),
+    never the other way around. Is cleared once `capacity` is exceeded, so a long
+    session starts over instead of excluding almost everything. Concurrent
+    requests of one session share the filter, so it is guarded by a lock
+    '''
+
+    def __init__(self, bits: int, hashes: int) -> None:
+        self.bits = bits
+        self.hashes = hashes
+        self.filter = bytearray((bits + 7) // 8)
+        self.count = 0
+        # for the optimal number of hashes false positive rate is ~1% at this fill
+        self.capacity = int(bits / 9.6)
+        self.lock = Lock()
+
+    def _positions(self, id: int):
+        h1 = (id * 0x9E3779B97F4A7C15) & MASK_64
+        h2 = ((id * 0xC2B2AE3D27D4EB4F) & MASK_64) | 1
+        for i in range(self.hashes):
+            yield ((h1 + i * h2) & MASK_64) % self.bits
+
+    def __contains__(self, id: int) -> bool:
+        with self.lock:
+            return all(self.filter[p >> 3] & (1 << (p & 7)) for p in self._positions(id))
+
+    def add(self, id: int) -> None:
+        with self.lock:
+            if self.count >= self.capacity:
+                self._clear()
+            for p in self._positions(id):
+                self.filter[p >> 3] |= 1 << (p & 7)
+            self.count += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self._clear()
+
+    def _clear(self) -> None:
+        self.filter = bytearray(len(self.filter))
+        self.count = 0
+
+
+class SessionStore:
+    '''Exploration sessions: token -> seen images filter
+
+    Bounded LRU kept in memory of a process (with several uvicorn workers a client
+    must stick to one of them), sessions expire `ttl` seconds after the last use
+    '''
+
+    def __init__(self, max_size: int, ttl: float, bits: int, hashes: int) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.bits = bits
+        self.hashes = hashes
+        self.sessions: OrderedDict[str, tuple[SeenFilter, float]] = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, token: str | None) -> tuple[str, SeenFilter]:
+        'Returns the session, a new one (with a new token) for unknown or expired tokens'
+        now = monotonic()
+        with self.lock:
+            while self.sessions:  # expired sessions are the least recently used ones
+                oldest, (_, expires) = next(iter(self.sessions.items()))
+                if expires >= now:
+                    break
+                del self.sessions[oldest]
+
+            if token is None or token not in self.sessions:
+                token = uuid4().hex
+                seen = SeenFilter(self.bits, self.hashes)
+            else:
+                seen, _ = self.sessions[token]
+
+            self.sessions[token] = (seen, now + self.ttl)
+            self.sessions.move_to_end(token)
+            while len(self.sessions) > self.max_size:
+                self.sessions.popitem(last=False)
+
+        return token, seen
+
+
+exploration_sessions = SessionStore(
+    max_size=settings.EXPLORE_SESSIONS_MAX,
+    ttl=settings.EXPLORE_SESSION_TTL,
+    bits=settings.EXPLORE_SESSION_BITS,
+    hashes=settings.EXPLORE_SESSION_HASHES,
+)
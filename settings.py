@@ -9,8 +9,74 @@ class Settings(BaseSettings):
 
     RELOAD: bool = False
 
+    DB_URL: str = 'sqlite:///db.db'
+    DB_ENGINE_MODE: str = 'production'  # "production" (tuned, see db.py) or "default"
+    DB_JOURNAL_MODE: str = 'WAL'
+    DB_SYNCHRONOUS: str = 'NORMAL'  # durable with WAL except for the last commits on power loss
+    DB_BUSY_TIMEOUT: int = 5000  # ms to wait for a lock instead of "database is locked"
+    DB_MMAP_SIZE: int = 256 * 1024 * 1024
+    DB_CACHE_SIZE: int = -64 * 1024  # negative means KiB
+    DB_POOL_SIZE: int = 5
+    DB_POOL_MAX_OVERFLOW: int = 10
+
     IMAGES_PATH = 'images'
+    IMAGES_OBJECTS_DIR = 'objects'  # content-addressed store inside IMAGES_PATH
     IMAGES_BATCH_SIZE: int = 50
+    IMAGES_PAGE_SIZE: int = 100  # default /api/print_images page size
+    IMAGES_YIELD_PER: int = 1000  # rows fetched at once while streaming images
+    DOWNLOAD_CONCURRENCY: int = 4
+    DOWNLOAD_CHUNK_SIZE: int = 64 * 1024
+    FILES_OPEN_HANDLES: int = 256  # open image files kept by a process for serving
+    FILES_CHUNK_SIZE: int = 256 * 1024
+    FILES_MAX_AGE: int = 365 * 24 * 60 * 60  # seconds, image files never change
+    THUMBNAIL_WIDTHS: list[int] = [320, 640, 1080]  # derivatives made for every image
+    THUMBNAIL_FORMAT: str = 'webp'  # "webp" or "jpeg"
+    THUMBNAIL_QUALITY: int = 80
+    THUMBNAIL_WORKERS: int | None = None  # processes, None means number of CPUs
+    DUPLICATES_MAX_DISTANCE: int = 6  # max differing bits of perceptual hashes of copies
+    DUPLICATES_RELOAD_SECONDS: float = 300  # full reload of the hash index after changes by other processes
+
+    JOBS_WORKERS: int = 1  # album ingestion jobs run in parallel by a process
+    JOBS_STALE_SECONDS: int = 300  # running job of another host without progress for so long is resumed
+    JOBS_SWEEP_SECONDS: float = 60  # interval of checks for running jobs of dead processes
+
+    VK_API_URL: str = 'https://api.vk.com/method'  # e.g. benchmarks/fake_vk.py for offline runs
+    VK_REQUESTS_PER_SECOND: float = 3  # VK limit for user access tokens
+    VK_RETRIES: int = 5  # retries of calls failed with errors 6, 9, 10, 5xx or network errors
+    VK_BACKOFF: float = 0.5  # seconds, max delay before the first retry, doubled with every retry
+    VK_BACKOFF_MAX: float = 10
+    VK_TIMEOUT: float = 30  # seconds
+    VK_EXECUTE_BATCH_SIZE: int = 25  # calls combined into one execute request (VK allows 25), 1 disables
+
+    USERS_BATCH_SIZE: int = 1000  # max user_ids per users.get call
+    REFRESH_PAGE_SIZE: int = 1000  # images updated at once by refresh_images.py
+    REFRESH_BATCH_SIZE: int = 200  # photos per photos.getById call (combined by execute)
+    AUTHORS_CACHE_SIZE: int = 10000
+    AUTHORS_CACHE_TTL: int = 24 * 60 * 60  # seconds
+
+    LIKES_FLUSH_INTERVAL: float = 1  # seconds, max likes loss on crash
+    LIKES_FLUSH_EVERY: int = 100  # flush earlier after this many likes
+
+    SAMPLER_REFRESH_SECONDS: int = 30  # max staleness of likes made by other processes
+    EXPLORE_SESSIONS_MAX: int = 10000  # sessions kept by a process, see sessions.py
+    EXPLORE_SESSION_TTL: int = 60 * 60  # seconds since the last request
+    EXPLORE_SESSION_BITS: int = 32 * 1024  # seen filter size, remembers ~3400 images
+    EXPLORE_SESSION_HASHES: int = 7
+    EXPLORE_REJECTION_ATTEMPTS: int = 32  # draws before the seen filter is cleared
+    EXPLORE_PREFETCH_SIZE: int = 32  # pre-sampled images per favourite, 0 disables prefetching
+    EXPLORE_PREFETCH_FAVOURITES: int = 1000  # favourites with prefetch buffers kept by a process
+    EXPLORE_BATCH_MAX: int = 100  # max images returned by one batch request
+    IMAGE_CACHE_SIZE: int = 10000  # entries of every cache in image_cache.py
+    IMAGE_CACHE_TTL: int = 30  # max staleness of changes made by other processes
+
+    LEADERBOARD_SIZE: int = 100  # max dashboard n and k served from memory
+    LEADERBOARD_REFRESH_SECONDS: int = 5  # max staleness of likes made by other processes
+    DASHBOARD_STREAM_KEEPALIVE: float = 5  # seconds between keepalives and checks for foreign likes
+    DASHBOARD_STREAM_DEBOUNCE: float = 0.1  # seconds likes are collected before the dashboard is recomputed
+
+    PROFILE_SLOW_REQUESTS_MS: int = 0  # dump stacks of requests slower than this, 0 disables profiler
+    PROFILE_INTERVAL: float = 0.005  # seconds between stack samples
+    PROFILE_PATH: str = 'profiles'
 
     class Config:
         env_file = '.env'
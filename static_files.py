@@ -0,0 +1,208 @@
+import os
+import re
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from threading import Lock
+from fastapi import status
+from fastapi.responses import Response, StreamingResponse
+from metrics import cache_lookups
+from settings import settings
+
+
+class OpenFile:
+    'File descriptor shared by requests serving the same file'
+
+    def __init__(self, path: str) -> None:
+        self.fd = os.open(path, os.O_RDONLY)
+        stat = os.fstat(self.fd)
+        self.inode = stat.st_ino
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.refs = 0
+        self.evicted = False
+
+    def is_current(self, stat: os.stat_result) -> bool:
+        'Checks that the file was not replaced since it was opened'
+        return stat.st_ino == self.inode and stat.st_mtime_ns == self.mtime_ns
+
+
+class FileHandleCache:
+    '''LRU of open files
+
+    Hot files are served without `open`/`close` calls, only with `stat` to notice
+    files replaced on disk (see `storage.link_object`). Evicted files are closed
+    when the last request reading them releases them
+    '''
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.files: OrderedDict[str, OpenFile] = OrderedDict()
+        self.lock = Lock()
+
+    def acquire(self, path: str) -> OpenFile:
+        'Returns open file, raises FileNotFoundError. Must be paired with `release`'
+        stat = os.stat(path)
+        with self.lock:
+            file = self.files.get(path)
+            if file is not None and file.is_current(stat):
+                self.files.move_to_end(path)
+                file.refs += 1
+                cache_lookups.labels('file_handles', 'hit').inc()
+                return file
+
+        cache_lookups.labels('file_handles', 'miss').inc()
+        file = OpenFile(path)
+        with self.lock:
+            if (previous := self.files.pop(path, None)) is not None:
+                self._evict(previous)
+            self.files[path] = file
+            while len(self.files) > self.max_size:
+                self._evict(self.files.popitem(last=False)[1])
+            file.refs += 1
+            return file
+
+    def _evict(self, file: OpenFile) -> None:
+        file.evicted = True
+        if file.refs == 0:
+            os.close(file.fd)
+
+    def release(self, file: OpenFile) -> None:
+        with self.lock:
+            file.refs -= 1
+            if file.evicted and file.refs == 0:
+                os.close(file.fd)
+
+
+file_handles = FileHandleCache(max_size=settings.FILES_OPEN_HANDLES)
+
+
+def parse_range(range: str, size: int) -> tuple[int, int] | None:
+    '''Returns [start, end) of a single "bytes" range
+
+    Returns None for unsupported (e.g. multiple) ranges, so the whole file is sent,
+    raises ValueError for unsatisfiable ranges
+    '''
+    match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', range)
+    if match is None:
+        return None
+
+    start, end = match.groups()
+    if start == '' and end == '':
+        return None
+    if start == '':  # last `end` bytes
+        if int(end) == 0:
+            raise ValueError(range)
+        return max(size - int(end), 0), size
+    if int(start) >= size:
+        raise ValueError(range)
+    if end == '':
+        return int(start), size
+    if int(end) < int(start):
+        return None
+    return int(start), min(int(end) + 1, size)
+
+
+def read_chunks(file: OpenFile, start: int, end: int):
+    'Yields file contents from `start` to `end`'
+    while start < end:
+        chunk = os.pread(file.fd, min(settings.FILES_CHUNK_SIZE, end - start), start)
+        if not chunk:
+            break  # file was truncated
+        start += len(chunk)
+        yield chunk
+
+
+class FileStreamingResponse(StreamingResponse):
+    '''Streams part of an acquired file and releases it when the response is done
+
+    The file is released even if the body was never iterated (e.g. the client
+    disconnected before the first chunk or sending failed)
+    '''
+
+    def __init__(self, file: OpenFile, start: int, end: int, **kwargs) -> None:
+        super().__init__(read_chunks(file, start, end), **kwargs)
+        self.file = file
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            file_handles.release(self.file)
+
+
+def is_not_modified(
+    etag: str,
+    mtime: int,
+    if_none_match: str | None,
+    if_modified_since: str | None,
+) -> bool:
+    'If-Modified-Since is ignored when If-None-Match is given (RFC 7232)'
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return etag in tags or '*' in tags
+    if if_modified_since is not None:
+        try:
+            return mtime <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def file_response(
+    path: str,
+    etag: str | None = None,
+    media_type: str = 'image/jpeg',
+    if_none_match: str | None = None,
+    if_modified_since: str | None = None,
+    range: str | None = None,
+    if_range: str | None = None,
+) -> Response:
+    '''Serves file with conditional and range requests support
+
+    `etag` is a strong validator of the contents (e.g. its hash), by default it is
+    derived from the file size and modification time. Raises FileNotFoundError
+    '''
+    file = file_handles.acquire(path)
+    streaming = False
+    try:
+        if etag is None:
+            etag = f'"{file.size:x}-{file.mtime_ns:x}"'
+        last_modified = formatdate(file.mtime_ns / 1e9, usegmt=True)
+        headers = {
+            'ETag': etag,
+            'Last-Modified': last_modified,
+            'Cache-Control': f'public, max-age={settings.FILES_MAX_AGE}, immutable',
+            'Accept-Ranges': 'bytes',
+        }
+
+        if is_not_modified(etag, file.mtime_ns // 10**9, if_none_match, if_modified_since):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        start, end = 0, file.size
+        status_code = status.HTTP_200_OK
+        if range is not None and (if_range is None or if_range in (etag, last_modified)):
+            try:
+                byte_range = parse_range(range, file.size)
+            except ValueError:
+                return Response(
+                    status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                    headers={**headers, 'Content-Range': f'bytes */{file.size}'},
+                )
+            if byte_range is not None:
+                start, end = byte_range
+                status_code = status.HTTP_206_PARTIAL_CONTENT
+                headers['Content-Range'] = f'bytes {start}-{end - 1}/{file.size}'
+
+        headers['Content-Length'] = str(end - start)
+        streaming = True
+        return FileStreamingResponse(
+            file,
+            start,
+            end,
+            status_code=status_code,
+            headers=headers,
+            media_type=media_type,
+        )
+    finally:
+        if not streaming:
+            file_handles.release(file)
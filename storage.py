@@ -0,0 +1,87 @@
+import os
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+import requests
+from metrics import timed_download
+from settings import settings
+
+_local = threading.local()
+
+
+def http_session() -> requests.Session:
+    'Returns keep-alive session of the current thread'
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def object_path(sha256: str) -> Path:
+    'Path of the file with given content hash in the content-addressed store'
+    return Path(settings.IMAGES_PATH) / settings.IMAGES_OBJECTS_DIR / sha256[:2] / f'{sha256}.jpg'
+
+
+def link_object(sha256: str, path: str) -> None:
+    'Atomically places a hardlink (or a copy) of the stored object at `path`'
+    tmp_path = f'{path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    try:
+        os.link(object_path(sha256), tmp_path)
+    except OSError:  # no hardlinks support
+        shutil.copyfile(object_path(sha256), tmp_path)
+    os.replace(tmp_path, path)
+
+
+def download_object(url: str) -> tuple[str, int]:
+    '''Streams file to the store in chunks, returns its content hash and size
+
+    File is written to a temporary file and atomically renamed, so the store never
+    contains partially downloaded files
+    '''
+    tmp_dir = Path(settings.IMAGES_PATH) / settings.IMAGES_OBJECTS_DIR / 'tmp'
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    sha256 = hashlib.sha256()
+    size = 0
+    with timed_download() as downloaded, http_session().get(url, stream=True) as res:
+        res.raise_for_status()
+        with NamedTemporaryFile(dir=tmp_dir, delete=False) as f:
+            try:
+                for chunk in res.iter_content(chunk_size=settings.DOWNLOAD_CHUNK_SIZE):
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+        downloaded.append(size)
+
+    digest = sha256.hexdigest()
+    path = object_path(digest)
+    if path.exists():
+        os.remove(f.name)  # same content is already stored
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(f.name, path)
+
+    return digest, size
+
+
+def store_image(url: str, path: str, sha256: str | None = None) -> dict | None:
+    '''Places image from `url` at `path` backed by the content-addressed store
+
+    Download is skipped when content hash of the url is already known and stored.
+    Returns `image_files` row for downloaded files and None otherwise
+    '''
+    if sha256 is not None and object_path(sha256).exists():
+        link_object(sha256, path)
+        return None
+
+    sha256, size = download_object(url)
+    link_object(sha256, path)
+    return {'url': url, 'sha256': sha256, 'size': size}
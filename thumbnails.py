@@ -0,0 +1,226 @@
+import multiprocessing
+import os
+import click
+from concurrent.futures import Future, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from threading import Lock
+from typing import Callable
+from PIL import Image, ImageOps
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from db import DBSession, ImageDB, ImageDerivativeDB
+from settings import settings
+
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+MEDIA_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+
+def derivative_path(path: str, width: int, format: str) -> str:
+    'Derivatives are stored next to the original: images/<album_id>/<image_id>_w<width>.webp'
+    path = Path(path)
+    return str(path.with_name(f'{path.stem}_w{width}.{EXTENSIONS[format]}'))
+
+
+def make_derivative(path: str, width: int, format: str, quality: int) -> int:
+    '''Writes image resized to `width` (never upscaled) next to `path`, returns its size
+
+    Executed in worker processes
+    '''
+    target = derivative_path(path, width, format)
+    tmp_path = f'{target}.tmp'
+
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.width > width:
+            image = image.resize(
+                (width, max(round(image.height * width / image.width), 1)),
+                Image.LANCZOS,
+            )
+        if image.mode not in ('RGB', 'RGBA') or (format == 'jpeg' and image.mode != 'RGB'):
+            image = image.convert('RGB')
+        image.save(tmp_path, format=format.upper(), quality=quality)
+
+    os.replace(tmp_path, target)
+    return os.path.getsize(target)
+
+
+class ThumbnailGenerator:
+    '''Resized derivatives of stored images made by a process pool
+
+    Derivatives are made for all images by `generate` (ingestion stage) or lazily
+    by `get` on the first request. Concurrent requests of the same derivative wait
+    for a single conversion. Made derivatives are recorded in `image_derivatives`.
+    Workers are spawned, not forked: the pool is created lazily in a process that
+    already runs threads (API server, ingestion), and a fork may copy their held locks
+    '''
+
+    def __init__(self, widths: list[int], format: str, quality: int, workers: int | None) -> None:
+        self.widths = sorted(widths)
+        self.format = format
+        self.quality = quality
+        self.workers = workers
+        self.executor: ProcessPoolExecutor | None = None
+        self.futures: dict[tuple[int, int], Future] = {}
+        self.lock = Lock()
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.format]
+
+    def pick_width(self, width: int) -> int | None:
+        'Returns the smallest derivative width not less than `width` (None for the original)'
+        for derivative_width in self.widths:
+            if derivative_width >= width:
+                return derivative_width
+        return None
+
+    def _submit(self, image_id: int, path: str, width: int) -> tuple[Future, bool]:
+        'Returns conversion future and whether it was created by this call'
+        with self.lock:
+            if (future := self.futures.get((image_id, width))) is not None:
+                return future, False
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            future = self.executor.submit(make_derivative, path, width, self.format, self.quality)
+            self.futures[(image_id, width)] = future
+            return future, True
+
+    def _save(self, session: Session, derivatives: list[dict]) -> None:
+        if not derivatives:
+            return
+        statement = insert(ImageDerivativeDB)
+        session.execute(
+            statement.on_conflict_do_update(
+                index_elements=['image_id', 'width', 'format'],
+                set_={'path': statement.excluded.path, 'size': statement.excluded.size},
+            ),
+            derivatives,
+        )
+        session.commit()
+
+    def _row(self, image_id: int, path: str, width: int, size: int) -> dict:
+        return {
+            'image_id': image_id,
+            'width': width,
+            'format': self.format,
+            'path': derivative_path(path, width, self.format),
+            'size': size,
+        }
+
+    def get(self, image_id: int, path: str, width: int) -> str:
+        'Returns path of the derivative, making it if needed. Raises FileNotFoundError'
+        target = derivative_path(path, width, self.format)
+        if os.path.exists(target):
+            return target
+
+        future, created = self._submit(image_id, path, width)
+        if not created:
+            future.result()
+            return target
+
+        try:
+            size = future.result()
+            with DBSession() as session:
+                self._save(session, [self._row(image_id, path, width, size)])
+        finally:
+            with self.lock:
+                self.futures.pop((image_id, width), None)
+        return target
+
+    def generate(
+        self,
+        album_id: int | None = None,
+        print_info: bool = False,
+        progress: Callable[[dict], None] | None = None,
+    ) -> dict:
+        'Makes missing derivatives of stored images (of the album or all), returns stats'
+        stats = {'generated': 0, 'done': 0, 'total': 0, 'bytes': 0, 'errors': 0}
+
+        with DBSession() as session:
+            query = select(ImageDB.id, ImageDB.path).order_by(ImageDB.id)
+            if album_id is not None:
+                query = query.where(ImageDB.album_id == album_id)
+            images = session.execute(query).all()
+
+            made = set(
+                session.execute(
+                    select(ImageDerivativeDB.image_id, ImageDerivativeDB.width)
+                    .where(ImageDerivativeDB.format == self.format)
+                ).all()
+            )
+            tasks = [
+                (id, path, width)
+                for id, path in images
+                for width in self.widths
+                if (id, width) not in made or not os.path.exists(derivative_path(path, width, self.format))
+            ]
+            stats['total'] = len(tasks)
+
+            in_flight: dict[Future, tuple[int, str, int, bool]] = {}
+            max_in_flight = 2 * (self.workers or os.cpu_count() or 1)
+
+            def collect(done: set[Future]) -> None:
+                rows = []
+                for future in done:
+                    id, path, width, created = in_flight.pop(future)
+                    if created:
+                        with self.lock:
+                            self.futures.pop((id, width), None)
+                    stats['done'] += 1
+                    if (error := future.exception()) is not None:
+                        stats['errors'] += 1
+                        if print_info:
+                            click.echo(f'Не удалось обработать изображение {path}: {error}', err=True)
+                    elif created:
+                        rows.append(self._row(id, path, width, future.result()))
+                        stats['generated'] += 1
+                        stats['bytes'] += future.result()
+                self._save(session, rows)
+
+            for id, path, width in tasks:
+                if not os.path.exists(path):
+                    stats['done'] += 1
+                    stats['errors'] += 1
+                    continue
+                if len(in_flight) >= max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                    if progress is not None:
+                        progress(stats)
+                future, created = self._submit(id, path, width)
+                in_flight[future] = (id, path, width, created)
+
+            collect(wait(in_flight).done)
+
+        if progress is not None:
+            progress(stats)
+        if print_info:
+            click.echo(
+                f'Создано уменьшенных копий: {stats["generated"]}'
+                + (f', ошибок: {stats["errors"]}' if stats['errors'] else '')
+            )
+
+        return stats
+
+
+thumbnails = ThumbnailGenerator(
+    widths=settings.THUMBNAIL_WIDTHS,
+    format=settings.THUMBNAIL_FORMAT,
+    quality=settings.THUMBNAIL_QUALITY,
+    workers=settings.THUMBNAIL_WORKERS,
+)
+
+
+@click.command()
+@click.option("--album-id", type=int, default=None, help="ID альбома (по умолчанию все альбомы)")
+@click.option("--no-print-info", default=False, is_flag=True, help="Скрыть доп. информацию с консоли")
+def main(album_id: int | None, no_print_info: bool):
+    """Script that makes resized copies of downloaded images"""
+    thumbnails.generate(album_id=album_id, print_info=not no_print_info)
+
+
+if __name__ == '__main__':
+    main()
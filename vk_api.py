@@ -1,6 +1,191 @@
+import json
+import random
+import threading
+from time import sleep
+from typing import Any
 import requests
+from rate_limit import TokenBucket
+from metrics import timed_vk_call, vk_api_retries
 from settings import settings
 
+API_VERSION = '5.131'
+EXECUTE_MAX_CALLS = 25  # VK limit of API calls made by one `execute`
+# too many requests per second, flood control, internal server error
+RETRY_ERRORS = {6, 9, 10}
+
+
+class VKError(Exception):
+    'Error returned by VK API'
+
+    def __init__(self, code: int | None, message: str) -> None:
+        super().__init__(f'VK API error {code}: {message}')
+        self.code = code
+
+
+def retry_reason(error: Exception) -> str | None:
+    'Returns metric label of a retryable error, None for errors that should not be retried'
+    if isinstance(error, VKError):
+        return f'error_{error.code}' if error.code in RETRY_ERRORS else None
+    if isinstance(error, requests.HTTPError):
+        status_code = error.response.status_code
+        return f'http_{status_code}' if status_code >= 500 or status_code == 429 else None
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return 'network'
+    return None
+
+
+class VKClient:
+    '''VK API client with keep-alive connections, throttling and retries
+
+    Every request (an `execute` too) takes a token from `limiter` shared by all
+    threads of a process. Calls failed with `RETRY_ERRORS`, 5xx responses or
+    network errors are retried up to `retries` times after random delays of up to
+    `backoff * 2 ** attempt` seconds (at most `backoff_max`). `execute` combines
+    up to 25 calls into one request
+    '''
+
+    def __init__(
+        self,
+        url: str,
+        access_token: str,
+        limiter: TokenBucket,
+        retries: int,
+        backoff: float,
+        backoff_max: float,
+        timeout: float,
+        execute_batch_size: int,
+    ) -> None:
+        self.url = url
+        self.access_token = access_token
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.execute_batch_size = max(1, min(execute_batch_size, EXECUTE_MAX_CALLS))
+        self.local = threading.local()
+
+    def _session(self) -> requests.Session:
+        'Returns keep-alive session of the current thread'
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def _request(self, method: str, params: dict) -> Any:
+        self.limiter.acquire()
+        params = {**params, 'access_token': self.access_token, 'v': API_VERSION}
+        if method == 'execute':  # code may not fit into URL
+            res = self._session().post(f'{self.url}/{method}', data=params, timeout=self.timeout)
+        else:
+            res = self._session().get(f'{self.url}/{method}', params=params, timeout=self.timeout)
+        res.raise_for_status()
+
+        try:
+            body = res.json()
+        except ValueError:
+            raise VKError(None, f'{res}: {res.text}')
+        if 'error' in body:
+            raise VKError(body['error'].get('error_code'), body['error'].get('error_msg', ''))
+        if 'response' not in body:
+            raise VKError(None, f'{res}: {res.text}')
+        return body['response']
+
+    def call(self, method: str, **params) -> Any:
+        'Calls API method with retries, returns its response'
+        with timed_vk_call(method):
+            for attempt in range(self.retries + 1):
+                try:
+                    return self._request(method, params)
+                except Exception as error:
+                    reason = retry_reason(error)
+                    if reason is None or attempt == self.retries:
+                        raise
+                    vk_api_retries.labels(method, reason).inc()
+                    sleep(random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt)))
+
+    def execute(self, calls: list[tuple[str, dict]]) -> list:
+        '''Makes calls with `execute` requests of up to `execute_batch_size` calls,
+        returns their responses in order
+
+        Calls failed inside `execute` (VK returns false for them) are repeated one by one
+        '''
+        responses = []
+        for i in range(0, len(calls), self.execute_batch_size):
+            batch = calls[i:i + self.execute_batch_size]
+            if len(batch) == 1:
+                method, params = batch[0]
+                responses.append(self.call(method, **params))
+                continue
+
+            code = 'return [{}];'.format(','.join(
+                f'API.{method}({json.dumps(params, ensure_ascii=False)})'
+                for method, params in batch
+            ))
+            batch_responses = self.call('execute', code=code)
+            if not isinstance(batch_responses, list) or len(batch_responses) != len(batch):
+                count = len(batch_responses) if isinstance(batch_responses, list) else 'no list of'
+                raise VKError(None, f'execute returned {count} responses for {len(batch)} calls')
+            for (method, params), response in zip(batch, batch_responses):
+                responses.append(self.call(method, **params) if response is False else response)
+        return responses
+
+    def get_images(self, owner_id: int, album_id: int, offset: int = 0, count: int = 50) -> dict:
+        return self.call('photos.get', **photos_get_params(owner_id, album_id, offset, count))
+
+    def get_images_pages(self, owner_id: int, album_id: int, offsets: list[int], count: int = 50) -> list[dict]:
+        'Returns `photos.get` responses for every offset'
+        return self.execute([
+            ('photos.get', photos_get_params(owner_id, album_id, offset, count))
+            for offset in offsets
+        ])
+
+    def get_images_by_ids(self, owner_id: int, images_ids: list[int], batch_size: int) -> list[dict]:
+        '''Returns `photos.getById` photos (with likes) requested by calls of
+        `batch_size` IDs combined by `execute`, deleted photos are missing
+        '''
+        responses = self.execute([
+            ('photos.getById', {
+                'photos': ','.join(f'{owner_id}_{id}' for id in images_ids[i:i + batch_size]),
+                'extended': 1,
+            })
+            for i in range(0, len(images_ids), batch_size)
+        ])
+        return [photo for response in responses for photo in response]
+
+    def get_users(self, users_ids: list[int] | set[int]) -> list:
+        return self.call('users.get', user_ids=','.join(map(str, users_ids)))
+
+    def get_users_batches(self, batches: list[list[int]]) -> list[list]:
+        'Returns `users.get` responses for every batch of IDs'
+        return self.execute([
+            ('users.get', {'user_ids': ','.join(map(str, users_ids))})
+            for users_ids in batches
+        ])
+
+
+def photos_get_params(owner_id: int, album_id: int, offset: int, count: int) -> dict:
+    return {
+        'owner_id': owner_id,
+        'album_id': album_id,
+        'extended': 1,
+        'photo_sizes': 1,
+        'offset': offset,
+        'count': count,
+    }
+
+
+vk_limiter = TokenBucket(settings.VK_REQUESTS_PER_SECOND)
+vk_client = VKClient(
+    url=settings.VK_API_URL,
+    access_token=settings.ACCESS_TOKEN,
+    limiter=vk_limiter,
+    retries=settings.VK_RETRIES,
+    backoff=settings.VK_BACKOFF,
+    backoff_max=settings.VK_BACKOFF_MAX,
+    timeout=settings.VK_TIMEOUT,
+    execute_batch_size=settings.VK_EXECUTE_BATCH_SIZE,
+)
+
 
 def get_images(
     owner_id: int,
@@ -8,43 +193,31 @@ def get_images(
     offset: int = 0,
     count: int = 50
 ) -> dict:
-    res = requests.get(
-        'https://api.vk.com/method/photos.get',
-        params={
-            'access_token': settings.ACCESS_TOKEN,
-            'owner_id': owner_id,
-            'album_id': album_id,
-            'extended': 1,
-            'photo_sizes': 1,
-            'v': '5.131',
-            'offset': offset,
-            'count': count,
-        }
-    )
-    if res.status_code != 200:
-        raise Exception(f'{res}: {res.text}')
-
-    try:
-        return res.json()['response']
-    except:
-        raise Exception(f'{res}: {res.text}')
+    return vk_client.get_images(owner_id, album_id, offset, count)
+
+
+def get_images_pages(
+    owner_id: int,
+    album_id: int,
+    offsets: list[int],
+    count: int = 50
+) -> list[dict]:
+    return vk_client.get_images_pages(owner_id, album_id, offsets, count)
+
+
+def get_images_by_ids(
+    owner_id: int,
+    images_ids: list[int],
+    batch_size: int = 200
+) -> list[dict]:
+    return vk_client.get_images_by_ids(owner_id, images_ids, batch_size)
 
 
 def get_users(
     users_ids: list[int] | set[int]
 ) -> list:
-    res = requests.get(
-        'https://api.vk.com/method/users.get',
-        params={
-            'access_token': settings.ACCESS_TOKEN,
-            'user_ids': ','.join(map(str, users_ids)),
-            'v': '5.131',
-        }
-    )
-    if res.status_code != 200:
-        raise Exception(f'{res}: {res.text}')
-
-    try:
-        return res.json()['response']
-    except:
-        raise Exception(f'{res}: {res.text}')
+    return vk_client.get_users(users_ids)
+
+
+def get_users_batches(batches: list[list[int]]) -> list[list]:
+    return vk_client.get_users_batches(batches)